@@ -2,7 +2,9 @@
 
 import os
 import sys
+import math
 import socket
+import struct
 import paho.mqtt.client as mqtt
 from gpiozero import RotaryEncoder, Button
 from threading import Event, Timer
@@ -11,6 +13,29 @@ import configparser
 # Delay between reconnection attempts
 recon_timer = None
 
+# Must match the server's UDP_FORMAT and UDP_COMMANDS
+UDP_FORMAT = struct.Struct('!BBHff')
+UDP_COMMANDS = ['on', 'off', 'toggle', 'fade', 'set', 'upto', 'downto', 'inc', 'dec',
+    'set_hue', 'set_sat']
+
+class UDPSender:
+    def __init__(self, server):
+        host, _, port = server.partition(':')
+        self.addr = (host, int(port or 8124))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.seq = 0
+
+    def send(self, index, cmd):
+        self.seq = (self.seq + 1) & 0xFFFF
+        packet = UDP_FORMAT.pack(index, UDP_COMMANDS.index(cmd), self.seq, math.nan, math.nan)
+        self.sock.sendto(packet, self.addr)
+
+def udp_index(config, cmds):
+    # Only use UDP if the server's index is known and it can carry the commands
+    if udp and 'index' in config and all(cmd in UDP_COMMANDS for cmd in cmds):
+        return int(config['index'])
+    return None
+
 class InputButton:
     def __init__(self, config):
         pull_up = False
@@ -22,9 +47,13 @@ class InputButton:
         self.btn.when_pressed = self.click
         self.topic = config['topic']
         self.cmd = config['cmd']
+        self.index = udp_index(config, [self.cmd])
 
     def click(self):
-        client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.cmd+'"}', qos=2)
+        if self.index is not None:
+            udp.send(self.index, self.cmd)
+        else:
+            client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.cmd+'"}', qos=2)
 
 class InputRotary:
     def __init__(self, config):
@@ -34,17 +63,24 @@ class InputRotary:
         self.cw_cmd = config['cw_cmd']
         self.ccw_cmd = config['ccw_cmd']
         self.topic = config['topic']
+        self.index = udp_index(config, [self.cw_cmd, self.ccw_cmd])
 
     def cw(self):
-        client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.cw_cmd+'"}', qos=2)
+        if self.index is not None:
+            udp.send(self.index, self.cw_cmd)
+        else:
+            client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.cw_cmd+'"}', qos=2)
 
     def ccw(self):
-        client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.ccw_cmd+'"}', qos=2)
+        if self.index is not None:
+            udp.send(self.index, self.ccw_cmd)
+        else:
+            client.publish(f'cmd/{self.topic}/req', '{"cmd": "'+self.ccw_cmd+'"}', qos=2)
 
 def parse_config():
     if config.sections():
         for section in config.sections():
-            if section == 'mqtt':
+            if section in ('mqtt', 'udp'):
                 continue
             inputtype = config[section].get('type', 'button').lower()
             if inputtype == 'button':
@@ -92,6 +128,7 @@ if __name__ == '__main__':
     devs = {}
     config = configparser.ConfigParser()
     config.read('/etc/mqtt-buttons.ini')
+    udp = UDPSender(config['udp'].get('server', '127.0.0.1:8124')) if 'udp' in config else None
     parse_config()
     client = mqtt.Client(client_id=get_client_id(config), clean_session=False)
     client.on_disconnect = reconnect
@@ -1,11 +1,37 @@
 #!/usr/bin/env python
 
 import os
+import math
+import socket
+import struct
 from urllib import request
 from gpiozero import RotaryEncoder, Button
 from threading import Event
 import configparser
 
+# Must match the server's UDP_FORMAT and UDP_COMMANDS
+UDP_FORMAT = struct.Struct('!BBHff')
+UDP_COMMANDS = ['on', 'off', 'toggle', 'fade', 'set', 'upto', 'downto', 'inc', 'dec',
+    'set_hue', 'set_sat']
+
+class UDPSender:
+    def __init__(self, server):
+        host, _, port = server.partition(':')
+        self.addr = (host, int(port or 8124))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.seq = 0
+
+    def send(self, index, cmd):
+        self.seq = (self.seq + 1) & 0xFFFF
+        packet = UDP_FORMAT.pack(index, UDP_COMMANDS.index(cmd), self.seq, math.nan, math.nan)
+        self.sock.sendto(packet, self.addr)
+
+def udp_index(config, cmds):
+    # Only use UDP if the server's index is known and it can carry the commands
+    if udp and 'index' in config and all(cmd in UDP_COMMANDS for cmd in cmds):
+        return int(config['index'])
+    return None
+
 class InputButton:
     def __init__(self, config):
         pull_up = False
@@ -18,9 +44,13 @@ class InputButton:
         self.led = config.get('led', 'led')
         self.server = config.get('server', '127.0.0.1:8123')
         self.cmd = config.get('cmd', 'toggle')
+        self.index = udp_index(config, [self.cmd])
 
     def click(self):
-        request.urlopen(f'http://{self.server}/{self.led}/{self.cmd}')
+        if self.index is not None:
+            udp.send(self.index, self.cmd)
+        else:
+            request.urlopen(f'http://{self.server}/{self.led}/{self.cmd}')
 
 class InputRotary:
     def __init__(self, config):
@@ -31,17 +61,24 @@ class InputRotary:
         self.server = config.get('server', '127.0.0.1:8123')
         self.cw_cmd = config.get('cw_cmd', 'inc')
         self.ccw_cmd = config.get('ccw_cmd', 'dec')
+        self.index = udp_index(config, [self.cw_cmd, self.ccw_cmd])
 
     def cw(self):
-        request.urlopen(f'http://{self.server}/{self.led}/{self.cw_cmd}')
+        if self.index is not None:
+            udp.send(self.index, self.cw_cmd)
+        else:
+            request.urlopen(f'http://{self.server}/{self.led}/{self.cw_cmd}')
 
     def ccw(self):
-        request.urlopen(f'http://{self.server}/{self.led}/{self.ccw_cmd}')
+        if self.index is not None:
+            udp.send(self.index, self.ccw_cmd)
+        else:
+            request.urlopen(f'http://{self.server}/{self.led}/{self.ccw_cmd}')
 
 def parse_config():
     if config.sections():
         for section in config.sections():
-            if section == 'rest':
+            if section in ('rest', 'udp'):
                 continue
             inputtype = config[section].get('type', 'button').lower()
             if inputtype == 'button':
@@ -53,6 +90,7 @@ if __name__ == '__main__':
     devs = {}
     config = configparser.ConfigParser()
     config.read('/etc/rest-buttons.ini')
+    udp = UDPSender(config['udp'].get('server', '127.0.0.1:8124')) if 'udp' in config else None
     parse_config()
     try:
         server = config['rest']['server']
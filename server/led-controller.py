@@ -9,13 +9,35 @@
 # - Save config changes to file
 # - Consider other functions like blink(), pulse(), strobe()
 
-from threading import Timer, Event, Thread
+from threading import Timer, Event, Thread, Condition, Lock, local, get_native_id
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from colorzero import Color
-from wiringpi import digitalWrite, pwmWrite, pinMode, OUTPUT, PWM_OUTPUT, wiringPiSetupGpio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
+import multiprocessing
 import configparser
 import os
 import json
+import time
+import math
+import socket
+import struct
+import heapq
+import re
+import fcntl
+import sys
+import random
+import cProfile
+import pstats
+import io
+import traceback
+import signal
+
+HAVE_WIRINGPI = True
+try:
+    from wiringpi import digitalWrite, pwmWrite, pinMode, OUTPUT, PWM_OUTPUT, wiringPiSetupGpio
+except ImportError:
+    HAVE_WIRINGPI = False
 
 HAVE_MQTT = True
 try:
@@ -31,9 +53,21 @@ try:
 except ImportError:
     HAVE_PCA = False
 
+HAVE_PIXELS = True
+try:
+    import numpy as np
+except ImportError:
+    HAVE_PIXELS = False
+
+HAVE_SPI = True
+try:
+    import spidev
+except ImportError:
+    HAVE_SPI = False
+
 HAVE_REST = True
 try:
-    from flask import Flask, abort
+    from flask import Flask, Response, abort, request
 except ImportError:
     HAVE_REST = False
 
@@ -44,12 +78,802 @@ PWM_MAX = 0x0400     # Pi's PWM scale
 PCA_MAX = 0xFFFF     # 12-bit resolution at the top of a 16-bit register
 MIN_STEP_TIME = 0.01 # 100fps is fast enough for me
 MIN_STEP_SIZE = MAX_LEVEL/PWM_MAX
+STREAM_BACKLOG = 256    # Status changes kept for slow stream clients
+STREAM_INTERVAL = 0.25  # Default minimum time between pushes to one client
+STREAM_KEEPALIVE = 15   # Seconds of silence before pinging a stream client
+UDP_PORT = 8124         # Used if [udp] has no port
+OUTPUT_PINS = 64        # GPIO numbers that fit in the shared framebuffer
+PCA_CHANNELS = 16
+SCHEDULE_FILE = '/var/lib/led-controller/schedule.json'
+SCHEDULE_MAX_WAIT = 60  # Re-check the clock at least this often, it may have been set by NTP
+RECORD_FILE = '/var/log/led-controller/commands.log'
+RECORD_SNAPSHOT_INTERVAL = 5    # Seconds after a recorded command to snapshot every light
+CONFIG_FILE = '/etc/led-controller.ini'
+CLUSTER_LEAD = 0.2      # Seconds between the master stamping a command and applying it
+CLUSTER_SYNC_INTERVAL = 10  # Seconds between clock pings to the master
+CLUSTER_SAMPLES = 16    # Clock pings kept, the fastest round trip wins
+CLUSTER_APPLIED = 256   # Recent cluster commands remembered to drop redelivered copies
+TRACE_FILE = '/var/log/led-controller/trace.json'
+TRACE_RATE = 0.1        # Fraction of commands traced
+TRACE_MAX_SIZE = 10000000   # Bytes before the trace file is rotated
+TRACE_KEEP = 3          # Rotated trace files kept
+PROFILE_MAX = 300       # Longest profile capture, in seconds
+PROFILE_LINES = 40      # Functions listed in a profile
+RESTORE_TIMEOUT = 2     # Seconds to wait for saved states from the broker at startup
+RESTORE_DURATION = 1    # Seconds to fade to the saved states
+PWM_PERIOD = 1000000    # Kernel PWM period in ns (1kHz)
+SYSFS_EXPORT_WAIT = 1   # Seconds to wait for udev after exporting a pin
+OUTPUT_SETUP_WAIT = 10  # Seconds to wait for the output process to open the hardware
+OUTPUT_IDLE_WAIT = 1    # Seconds the idle output process sleeps between checks on the server
+
+# Hardware PWM channel for each GPIO that has one
+PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+# GPIO character device, v1 line handle ABI (linux/gpio.h)
+GPIOHANDLE_REQUEST = struct.Struct('64I I 64B 32s I i')
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+GPIO_GET_LINEHANDLE_IOCTL = 0xC16CB403
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = 0xC040B409
+
+# Pixel strips on SPI
+WS2812_SPI_SPEED = 2400000  # 3 SPI bits per data bit
+APA102_SPI_SPEED = 8000000
+WS2812_RESET_BYTES = 24     # > 50us of low after each frame
+SERVICE_SECTIONS = ('mqtt', 'rest', 'udp', 'output', 'schedule', 'record', 'cluster', 'trace')
+
+# UDP datagram: LED index, command id, sequence number, 2 args (NaN = default)
+UDP_FORMAT = struct.Struct('!BBHff')
+UDP_COMMANDS = ['on', 'off', 'toggle', 'fade', 'set', 'upto', 'downto', 'inc', 'dec',
+    'set_hue', 'set_sat']
+
+# Shared buffer of status changes for /stream and /status clients.  Each
+# change is serialized once here, clients only join the frames they haven't
+# seen or get the cached body.
+class StatusStream:
+    def __init__(self, backlog=STREAM_BACKLOG):
+        self.seq = 0
+        self.boot = int(time.time())
+        self.events = deque(maxlen=backlog)
+        self.latest = {}
+        self.changed = Condition()
+        self.body = (0, '{}')
+
+    def publish(self, name, status):
+        status_json = json.dumps(status)
+        data = f'{{"name": {json.dumps(name)}, "status": {status_json}}}'
+        with self.changed:
+            if name in self.latest and self.latest[name][1] == status_json:
+                # Nothing changed, keep the version so pollers still get a 304
+                return
+            self.seq += 1
+            frame = f"id: {self.seq}\nevent: status\ndata: {data}\n\n"
+            self.events.append((self.seq, name, frame))
+            self.latest[name] = (self.seq, status_json, frame)
+            self.changed.notify_all()
+
+    def status(self, name=None):
+        # Returns (version, json body), rebuilding the full body only after a change
+        with self.changed:
+            if name is not None:
+                seq, status_json, frame = self.latest[name]
+                return seq, status_json
+            if self.body[0] != self.seq:
+                self.body = (self.seq, '{' + ', '.join(f'{json.dumps(n)}: {status_json}'
+                    for n, (seq, status_json, frame) in self.latest.items()) + '}')
+            return self.body
+
+    def snapshot(self, names=None):
+        with self.changed:
+            return self.seq, self._latest_frames(names)
+
+    def wait(self, cursor, names=None, timeout=None):
+        # Returns once one of names changes, or with no frames after timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.changed:
+            while True:
+                if self.events and self.events[0][0] > cursor + 1:
+                    # Fell behind the backlog, catch up from the latest state
+                    return self.seq, self._latest_frames(names)
+                pending = {}
+                for seq, name, frame in self.events:
+                    if seq > cursor and (names is None or name in names):
+                        pending[name] = frame
+                if pending:
+                    return self.seq, ''.join(pending.values())
+                # Only other lights changed, skip past them
+                cursor = self.seq
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return cursor, ''
+                self.changed.wait(remaining)
+
+    def _latest_frames(self, names):
+        return ''.join(frame for name, (seq, data, frame) in self.latest.items()
+            if names is None or name in names)
+
+status_stream = StatusStream()
+
+def open_pca():
+    global HAVE_PCA
+    if HAVE_PCA:
+        try:
+            pca = PCA9685(busio.I2C(SCL, SDA))
+            pca.frequency = 1000
+            return pca
+        except ValueError:
+            HAVE_PCA = False
+    return None
+
+# Writes straight to the hardware with wiringpi and the PCA9685
+class DirectOutput:
+    fades = False
+
+    def __init__(self, section={}):
+        self.pca = None
+
+    def setup(self):
+        if not HAVE_WIRINGPI:
+            raise Exception("Failed to load wiringpi module")
+        wiringPiSetupGpio()
+        self.pca = open_pca()
+
+    def has_pca(self):
+        return HAVE_PCA
+
+    def setup_pin(self, pin):
+        pinMode(pin, OUTPUT)
+
+    def setup_pwm(self, pin):
+        pinMode(pin, PWM_OUTPUT)
+
+    def digital_write(self, pin, value):
+        digitalWrite(pin, value)
+
+    def pwm_write(self, pin, value):
+        pwmWrite(pin, value)
+
+    def pca_write(self, channel, value):
+        self.pca.channels[channel].duty_cycle = value
+
+    def flush(self):
+        pass
+
+# Hands writes to a separate process that owns the hardware.  The control
+# process only stores values in shared memory.  For PWM and PCA9685 fades it
+# stores the endpoints, and the output process works out each step itself
+# every MIN_STEP_TIME, so fades stay smooth however busy REST/MQTT are.
+class SharedOutput:
+    fades = True
+
+    MODES = 0
+    DIGITAL = MODES + OUTPUT_PINS
+    SIZE = DIGITAL + OUTPUT_PINS
+    # Fade slots: PWM pins, then PCA channels
+    PCA = OUTPUT_PINS
+    FADE_SLOTS = PCA + PCA_CHANNELS
+
+    MODE_OUTPUT = 1
+    MODE_PWM = 2
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pca = False
+        # -1 = never written, so the output process leaves it alone
+        self.frame = multiprocessing.Array('i', [-1] * self.SIZE, lock=False)
+        # Each fade goes from start to end between times t0 and t1 (time.monotonic())
+        self.start = multiprocessing.Array('d', [-1] * self.FADE_SLOTS, lock=False)
+        self.end = multiprocessing.Array('d', [-1] * self.FADE_SLOTS, lock=False)
+        self.t0 = multiprocessing.Array('d', [0] * self.FADE_SLOTS, lock=False)
+        self.t1 = multiprocessing.Array('d', [0] * self.FADE_SLOTS, lock=False)
+        self.lock = multiprocessing.Lock()
+        self.wake = multiprocessing.Event()
+
+    def setup(self):
+        # The hardware is opened in the output process, which tells us how it went
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=self._run, args=(writer,), daemon=True)
+        self.process.start()
+        writer.close()
+        if not reader.poll(OUTPUT_SETUP_WAIT):
+            self.process.kill()
+            raise Exception("Output process didn't open the hardware in time")
+        try:
+            error, self.pca = reader.recv()
+        except EOFError:
+            raise Exception(f"Output process exited with code {self.process.exitcode} during setup")
+        if error:
+            raise Exception(f"Output process failed to open the hardware: {error}")
+        print(f"Output process started with pid {self.process.pid}")
+        Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        # Without the output process nothing reaches the lights, so stop and let systemd restart us
+        self.process.join()
+        print(f"Output process exited with code {self.process.exitcode}, stopping")
+        sys.stdout.flush()
+        os._exit(1)
+
+    def has_pca(self):
+        return self.pca
+
+    def _slot(self, base, pin, count=OUTPUT_PINS):
+        if not 0 <= pin < count:
+            raise Exception(f"pin {pin} is out of range for the output process")
+        return base + pin
+
+    def _set_fade(self, slot, start, end, t0, t1):
+        with self.lock:
+            self.start[slot] = start
+            self.end[slot] = end
+            self.t0[slot] = t0
+            self.t1[slot] = t1
+
+    def setup_pin(self, pin):
+        self.frame[self._slot(self.MODES, pin)] = self.MODE_OUTPUT
+
+    def setup_pwm(self, pin):
+        self.frame[self._slot(self.MODES, pin)] = self.MODE_PWM
+
+    def digital_write(self, pin, value):
+        self.frame[self._slot(self.DIGITAL, pin)] = value
+
+    def pwm_write(self, pin, value):
+        self._set_fade(self._slot(0, pin), value, value, 0, 0)
+
+    def pca_write(self, channel, value):
+        self._set_fade(self._slot(self.PCA, channel, PCA_CHANNELS), value, value, 0, 0)
+
+    def pwm_fade(self, pin, start, end, t0, t1):
+        self._set_fade(self._slot(0, pin), start, end, t0, t1)
+
+    def pca_fade(self, channel, start, end, t0, t1):
+        self._set_fade(self._slot(self.PCA, channel, PCA_CHANNELS), start, end, t0, t1)
+
+    def flush(self):
+        self.wake.set()
+
+    def _run(self, setup_done):
+        backend = self.backend
+        try:
+            backend.setup()
+        except Exception as e:
+            setup_done.send((str(e) or type(e).__name__, False))
+            return
+        setup_done.send((None, backend.has_pca()))
+        setup_done.close()
+        try:
+            self._copy_frames(backend)
+        except Exception:
+            print("Output process failed:")
+            traceback.print_exc()
+            sys.stdout.flush()
+            os._exit(1)
+
+    def _copy_frames(self, backend):
+        parent = os.getppid()
+        last = [-1] * self.SIZE
+        last_duty = [-1] * self.FADE_SLOTS
+        next_frame = time.monotonic()
+        while os.getppid() == parent:
+            # Cleared before reading, so a write after this wakes the next wait
+            self.wake.clear()
+            with self.lock:
+                frame = self.frame[:]
+                starts, ends = self.start[:], self.end[:]
+                t0s, t1s = self.t0[:], self.t1[:]
+            now = time.monotonic()
+
+            fading = False
+            duty = [-1] * self.FADE_SLOTS
+            for slot in range(self.FADE_SLOTS):
+                if starts[slot] == -1:
+                    continue
+                if now >= t1s[slot]:
+                    duty[slot] = int(ends[slot])
+                else:
+                    fading = True
+                    progress = max(now - t0s[slot], 0) / (t1s[slot] - t0s[slot])
+                    duty[slot] = int(starts[slot] + (ends[slot] - starts[slot]) * progress)
+
+            for pin in range(OUTPUT_PINS):
+                mode = frame[self.MODES + pin]
+                if mode == -1:
+                    continue
+                if mode != last[self.MODES + pin]:
+                    if mode == self.MODE_PWM:
+                        backend.setup_pwm(pin)
+                    else:
+                        backend.setup_pin(pin)
+                    last[self.MODES + pin] = mode
+                if mode == self.MODE_PWM:
+                    if duty[pin] != -1 and duty[pin] != last_duty[pin]:
+                        backend.pwm_write(pin, duty[pin])
+                        last_duty[pin] = duty[pin]
+                else:
+                    slot = self.DIGITAL + pin
+                    if frame[slot] != -1 and frame[slot] != last[slot]:
+                        backend.digital_write(pin, frame[slot])
+                        last[slot] = frame[slot]
+            for slot in range(self.PCA, self.FADE_SLOTS):
+                if duty[slot] != -1 and duty[slot] != last_duty[slot]:
+                    backend.pca_write(slot - self.PCA, duty[slot])
+                    last_duty[slot] = duty[slot]
+            backend.flush()
+
+            if not fading:
+                # Nothing to step, sleep until the next write (checking on our parent now and then)
+                self.wake.wait(OUTPUT_IDLE_WAIT)
+                next_frame = time.monotonic()
+                continue
+            # Keep a steady cadence, skip ahead rather than bunch up if we fell behind
+            next_frame += MIN_STEP_TIME
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.monotonic()
+
+# Keeps the last value written to each pin without touching any hardware
+class SimulatedOutput:
+    fades = False
+
+    def __init__(self, section={}):
+        self.values = {}
+        self.writes = 0
+
+    def setup(self):
+        print("Using simulated output, no hardware will be changed")
+
+    def has_pca(self):
+        return True
+
+    def setup_pin(self, pin):
+        self.values.setdefault(('gpio', pin), 0)
+
+    def setup_pwm(self, pin):
+        self.values.setdefault(('pwm', pin), 0)
+
+    def digital_write(self, pin, value):
+        self.values[('gpio', pin)] = value
+        self.writes += 1
+
+    def pwm_write(self, pin, value):
+        self.values[('pwm', pin)] = value
+        self.writes += 1
+
+    def pca_write(self, channel, value):
+        self.values[('pca', channel)] = value
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+# Drives the kernel's PWM and GPIO drivers, no wiringpi or root needed.
+# Files and line handles stay open, writes are collected until flush() and
+# then written together: all GPIO lines in a single ioctl.
+class SysfsOutput:
+    fades = False
+
+    def __init__(self, section={}):
+        self.root = section.get('root', '/')
+        self.gpio_mode = section.get('gpio', 'chardev').lower()
+        self.gpio_chip = section.get('gpio_chip', '/dev/gpiochip0')
+        self.gpio_base = int(section.get('gpio_base', 0))
+        self.pwm_chip = section.get('pwm_chip', 'pwmchip0')
+        self.pca_chip = section.get('pca_chip', None)
+        self.period = int(section.get('pwm_period', PWM_PERIOD))
+        # Plain files in a test tree need truncating, sysfs attributes don't
+        self.truncate = self.root != '/'
+        self.lines = []
+        self.gpio_values = {}
+        self.gpio_files = {}
+        self.line_fd = None
+        self.pwm_values = {}
+        self.pwm_files = {}
+        self.pca_files = {}
+        self.pending = {}
+        self.pca = None
+
+    def _path(self, *parts):
+        return os.path.join(self.root, 'sys/class', *parts)
+
+    def _write(self, fd, value):
+        data = str(value).encode()
+        os.pwrite(fd, data, 0)
+        if self.truncate:
+            os.ftruncate(fd, len(data))
+
+    def _write_file(self, path, value):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            self._write(fd, value)
+        finally:
+            os.close(fd)
+
+    def _export(self, export_dir, number, exported):
+        if not os.path.isdir(exported):
+            self._write_file(os.path.join(export_dir, 'export'), number)
+            # udev may still be fixing permissions
+            deadline = time.monotonic() + SYSFS_EXPORT_WAIT
+            while not os.path.isdir(exported) and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+    def _open_pwm(self, chip, channel):
+        pwm = self._path('pwm', chip, f'pwm{channel}')
+        self._export(self._path('pwm', chip), channel, pwm)
+        self._write_file(os.path.join(pwm, 'period'), self.period)
+        fd = os.open(os.path.join(pwm, 'duty_cycle'), os.O_WRONLY)
+        self._write(fd, 0)
+        self._write_file(os.path.join(pwm, 'enable'), 1)
+        return fd
+
+    def setup(self):
+        if self.pca_chip is None:
+            self.pca = open_pca()
+        print(f"Using kernel {self.gpio_mode} GPIO and {self.pwm_chip} for output")
+
+    def has_pca(self):
+        return self.pca_chip is not None or HAVE_PCA
+
+    def setup_pin(self, pin):
+        value = self.gpio_values.setdefault(pin, 0)
+        if self.gpio_mode == 'sysfs':
+            gpio = self._path('gpio', f'gpio{self.gpio_base + pin}')
+            self._export(self._path('gpio'), self.gpio_base + pin, gpio)
+            self._write_file(os.path.join(gpio, 'direction'), 'high' if value else 'low')
+            self.gpio_files[pin] = os.open(os.path.join(gpio, 'value'), os.O_WRONLY)
+        elif pin not in self.lines:
+            # One handle holds every line, so it has to be requested again with the new one
+            self.lines.append(pin)
+            if self.line_fd is not None:
+                os.close(self.line_fd)
+            request = bytearray(GPIOHANDLE_REQUEST.size)
+            offsets = self.lines + [0] * (64 - len(self.lines))
+            values = [1 if self.gpio_values.get(line) else 0 for line in self.lines]
+            GPIOHANDLE_REQUEST.pack_into(request, 0, *offsets, GPIOHANDLE_REQUEST_OUTPUT,
+                *(values + [0] * (64 - len(values))), b'led-controller', len(self.lines), 0)
+            chip = os.open(os.path.join(self.root, self.gpio_chip.lstrip('/')), os.O_RDONLY)
+            try:
+                fcntl.ioctl(chip, GPIO_GET_LINEHANDLE_IOCTL, request, True)
+            finally:
+                os.close(chip)
+            self.line_fd = GPIOHANDLE_REQUEST.unpack_from(request)[-1]
+
+    def setup_pwm(self, pin):
+        if pin not in PWM_CHANNELS:
+            raise Exception(f"GPIO {pin} has no hardware PWM")
+        self.pwm_files[pin] = self._open_pwm(self.pwm_chip, PWM_CHANNELS[pin])
+        self.pending[('pwm', pin)] = self.pwm_values.get(pin, 0)
+
+    def digital_write(self, pin, value):
+        self.gpio_values[pin] = value
+        self.pending[('gpio', pin)] = value
+
+    def pwm_write(self, pin, value):
+        self.pwm_values[pin] = value
+        self.pending[('pwm', pin)] = value
+
+    def pca_write(self, channel, value):
+        if self.pca_chip is None:
+            self.pca.channels[channel].duty_cycle = value
+        else:
+            self.pending[('pca', channel)] = value
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        gpio_changed = False
+        for (kind, pin), value in pending.items():
+            if kind == 'gpio':
+                if pin in self.gpio_files:
+                    self._write(self.gpio_files[pin], 1 if value else 0)
+                gpio_changed = True
+            elif kind == 'pwm':
+                if pin in self.pwm_files:
+                    self._write(self.pwm_files[pin], value * self.period // PWM_MAX)
+            else:
+                if pin not in self.pca_files:
+                    self.pca_files[pin] = self._open_pwm(self.pca_chip, pin)
+                self._write(self.pca_files[pin], value * self.period // PCA_MAX)
+        if gpio_changed and self.line_fd is not None:
+            values = bytes(1 if self.gpio_values.get(line) else 0 for line in self.lines)
+            fcntl.ioctl(self.line_fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, values.ljust(64, b'\0'))
+
+OUTPUT_BACKENDS = {
+    'wiringpi' : DirectOutput,
+    'sysfs'    : SysfsOutput,
+    'simulated': SimulatedOutput
+}
+
+output = DirectOutput()
+
+# Appends every command received over MQTT or REST to a log file, one JSON
+# list per line: [time, source, led, command, status after].  Every few
+# seconds after a command, and on shutdown, a [time, "snapshot", null, null,
+# {led: status}] line records every light, including ones changed by groups,
+# the scheduler, UDP or the cluster.  Replay it with tools/led-replay.py
+class CommandRecorder:
+    def __init__(self):
+        self.file = None
+        self.lock = Lock()
+        self.recorded = False
+
+    def open(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', buffering=1)
+        Thread(target=self._snapshots, daemon=True).start()
+        signal.signal(signal.SIGTERM, self._stop)
+        print(f"Recording commands to {path}")
+
+    def copy(self, data):
+        # Commands get changed as they run, keep the original to record
+        if not self.file:
+            return None
+        return dict(data) if isinstance(data, dict) else data
+
+    def record(self, received, source, led, data):
+        if data is None:
+            return
+        line = json.dumps([round(received, 4), source, led.name, data, led._get_status()],
+            separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.recorded = True
+
+    def snapshot(self):
+        # Statuses are already serialized for the status stream
+        with status_stream.changed:
+            statuses = ','.join(f'{json.dumps(name)}:{status_json}'
+                for name, (seq, status_json, frame) in status_stream.latest.items())
+        with self.lock:
+            self.file.write(f'[{round(time.time(), 4)},"snapshot",null,null,{{{statuses}}}]\n')
+            self.recorded = False
+
+    def _snapshots(self):
+        while True:
+            time.sleep(RECORD_SNAPSHOT_INTERVAL)
+            if self.recorded:
+                self.snapshot()
+
+    def _stop(self, signum, frame):
+        self.snapshot()
+        os._exit(0)
+
+recorder = CommandRecorder()
+
+# Opt-in timing of commands, see [trace] in README.md.  Sampled commands
+# are written as Chrome trace events (chrome://tracing or ui.perfetto.dev)
+class Span:
+    __slots__ = ('events', 'name', 'args', 'start')
+
+    def __init__(self, events, name, args):
+        self.events = events
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.events.append((self.name, self.start, time.time() - self.start, self.args))
+
+NO_SPAN = nullcontext()
+
+class Tracer:
+    def __init__(self):
+        self.rate = 0
+        self.path = None
+        self.file = None
+        self.first = True
+        self.lock = Lock()
+        self.local = local()
+        self.profiling = False
+        self.profiler = None
+        self.profile_lock = Lock()
+
+    def configure(self, section):
+        self.rate = section.getfloat('rate', TRACE_RATE)
+        self.path = section.get('file', TRACE_FILE)
+        self.max_size = section.getint('max_size', TRACE_MAX_SIZE)
+        self.keep = section.getint('keep', TRACE_KEEP)
+        self.profiling = section.getboolean('profile', False)
+        if self.rate > 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._open()
+            print(f"Tracing {self.rate:.0%} of commands to {self.path}")
+
+    def _open(self):
+        self.file = open(self.path, 'a')
+        self.first = self.file.tell() == 0
+        if self.first:
+            self.file.write('[\n')
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.keep:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    @contextmanager
+    def command(self, name, source):
+        # Wraps everything done for one command, from parsing to publishing
+        profiler = None
+        if self.profiler:
+            # Only trust it under the lock, profile() may have just finished
+            self.profile_lock.acquire()
+            profiler = self.profiler
+            if profiler:
+                profiler.enable()
+            else:
+                self.profile_lock.release()
+        sampled = (self.file is not None and getattr(self.local, 'events', None) is None
+            and random.random() < self.rate)
+        if sampled:
+            self.local.events = []
+        start = time.time()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profile_lock.release()
+            if sampled:
+                events = self.local.events
+                self.local.events = None
+                events.append((f"{source} {name}", start, time.time() - start, {'led': name}))
+                self._write(events)
+
+    def span(self, name, **args):
+        # Cheap unless this thread is running a sampled command
+        events = getattr(self.local, 'events', None)
+        if events is None:
+            return NO_SPAN
+        return Span(events, name, args)
+
+    def _write(self, events):
+        pid = os.getpid()
+        tid = get_native_id()
+        lines = [json.dumps({'name': name, 'cat': 'command', 'ph': 'X', 'ts': round(start * 1e6),
+            'dur': round(duration * 1e6, 1), 'pid': pid, 'tid': tid, 'args': args})
+            for name, start, duration, args in events]
+        with self.lock:
+            try:
+                if self.file.tell() > self.max_size:
+                    self._rotate()
+                self.file.write(('' if self.first else ',\n') + ',\n'.join(lines))
+                self.file.flush()
+                self.first = False
+            except OSError as e:
+                print(f"Failed to write trace to {self.path}: {e}")
+
+    def profile(self, seconds):
+        # Profiles every command run in the next few seconds, one at a time
+        profiler = cProfile.Profile()
+        with self.profile_lock:
+            if self.profiler:
+                return None
+            self.profiler = profiler
+        time.sleep(seconds)
+        with self.profile_lock:
+            self.profiler = None
+        out = io.StringIO()
+        try:
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        except TypeError:
+            out.write(f"No commands ran in {seconds} seconds\n")
+        return out.getvalue()
+
+tracer = Tracer()
+
+# Wraps another backend to time its writes in traced commands
+class TracedOutput:
+    def __init__(self, backend):
+        self.backend = backend
+        self.fades = backend.fades
+
+    def setup(self):
+        self.backend.setup()
+
+    def has_pca(self):
+        return self.backend.has_pca()
+
+    def setup_pin(self, pin):
+        self.backend.setup_pin(pin)
+
+    def setup_pwm(self, pin):
+        self.backend.setup_pwm(pin)
+
+    def digital_write(self, pin, value):
+        with tracer.span('digital_write', pin=pin):
+            self.backend.digital_write(pin, value)
+
+    def pwm_write(self, pin, value):
+        with tracer.span('pwm_write', pin=pin):
+            self.backend.pwm_write(pin, value)
+
+    def pca_write(self, channel, value):
+        with tracer.span('pca_write', channel=channel):
+            self.backend.pca_write(channel, value)
+
+    def pwm_fade(self, pin, start, end, t0, t1):
+        with tracer.span('pwm_fade', pin=pin):
+            self.backend.pwm_fade(pin, start, end, t0, t1)
+
+    def pca_fade(self, channel, start, end, t0, t1):
+        with tracer.span('pca_fade', channel=channel):
+            self.backend.pca_fade(channel, start, end, t0, t1)
+
+    def flush(self):
+        with tracer.span('flush'):
+            self.backend.flush()
+
+class CommandError(Exception):
+    pass
+
+def _to_int(value):
+    # REST args arrive as strings, accept "50.0" as well as "50"
+    return int(float(value))
+
+def _to_float(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(value)
+    return value
+
+# Each LED class declares its command args as [name, type, default] lists.
+# They're compiled once per class into this, then used by every interface.
+class CommandSchema:
+    converters = {int: _to_int, float: _to_float}
+
+    def __init__(self, cmd, fields):
+        self.cmd = cmd
+        self.fields = tuple((name, self.converters.get(datatype, datatype), datatype(value))
+            for name, datatype, value in fields)
+
+    def _convert(self, name, convert, value):
+        try:
+            return convert(value)
+        except (TypeError, ValueError, OverflowError):
+            raise CommandError(f"invalid {name} '{value}' for {self.cmd}")
+
+    def from_dict(self, data):
+        # Named args (MQTT), fill in anything missing
+        for name, convert, default in self.fields:
+            value = data.get(name)
+            data[name] = default if value is None else self._convert(name, convert, value)
+        return data
+
+    def from_list(self, args):
+        # Positional args (REST, UDP), None means use the default
+        if len(args) > len(self.fields):
+            raise CommandError(f"too many arguments for {self.cmd}, it takes {len(self.fields)}")
+        data = {'cmd': self.cmd}
+        for (name, convert, default), value in zip(self.fields, args):
+            data[name] = default if value is None else self._convert(name, convert, value)
+        for name, convert, default in self.fields[len(args):]:
+            data[name] = default
+        return data
 
 # Base class for controlling an LED with a GPIO pin
 class LEDPin:
     pintype = 'onoff'
-
-    def __init__(self, name, pin, level):
+    groups = ()
+    client = None
+    req_id = None
+    schema = {
+        'fade' : [['level', int, 0]],
+        'on'   : [['duration', float, 1]],
+        'off'  : [['level', int, 0], ['duration', float, 1]],
+    }
+
+    def __init__(self, name, pin, level, listen=True):
         self.name = name
         self.pin = int(pin)
         self._def_level(level)
@@ -60,11 +884,11 @@ class LEDPin:
         self.err_msg = None
         self.fade({'level': self.level, 'duration': 0})
         self._init_pin()
-        if 'mqtt' in config.sections():
+        if listen:
             self._mqtt_listen()
 
     def _init_pin(self):
-        pinMode(self.pin, OUTPUT)
+        output.setup_pin(self.pin)
 
     def _setup_cmds(self):
         self.commands = {
@@ -73,19 +897,23 @@ class LEDPin:
             'toggle': self.toggle,
             'fade'  : self.fade,
         }
-
-        self.defaults = {
-            'fade' : [['level', int, 0]],
-            'on'   : [['duration', float, 1]],
-            'off'  : [['level', int, 0], ['duration', float, 1]],
-        }
+        self._compile_schemas()
         self._setup_complete = False
 
+    @classmethod
+    def _compile_schemas(cls):
+        if 'schemas' in cls.__dict__:
+            return
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            fields.update(klass.__dict__.get('schema', {}))
+        cls.schemas = {cmd: CommandSchema(cmd, args) for cmd, args in fields.items()}
+
     def _def_level(self, level):
         self.level = 1 if level == 'on' else 0
 
     def _mqtt_listen(self):
-        if HAVE_MQTT:
+        if HAVE_MQTT and 'mqtt' in config.sections():
             self.topic = f"cmd/{config['mqtt'].get('topic','led')}/{self.name}"
             self._mqtt_setup()
 
@@ -97,68 +925,106 @@ class LEDPin:
         self.client.loop_start()
 
     def _mqtt_connect(self, client, userdata, flags, rc):
+        # Commands wait until restore_states() has set the saved state
+        if self._setup_complete:
+            self._mqtt_subscribe()
+
+    def _mqtt_subscribe(self):
         print(f"MQTT subscribing to topic {self.topic}/req")
         self.client.subscribe(f"{self.topic}/req")
 
-        # At startup, get our most recent state from the broker
-        if not self._setup_complete:
-            self.client.subscribe(f"{self.topic}/resp")
-
     def _mqtt_message(self, client, userdata, msg):
+        received = time.time()
         self.err_msg = None
-        if not self._setup_complete and msg.topic == f"{self.topic}/resp":
-            self._restore_state(msg)
+        with tracer.command(self.name, 'mqtt'):
+            data = None
+            # Keep every message as it arrived, valid or not, to replay it exactly
+            recorded = recorder.copy(msg.payload.decode(errors='replace'))
+            try:
+                with tracer.span('json'):
+                    data = json.loads(msg.payload)
+                recorded = recorder.copy(data)
+                if data['cmd'] in ('schedule', 'unschedule'):
+                    self._mqtt_schedule(data)
+                elif 'apply_at' in data:
+                    cluster.apply(self, data)
+                elif data['cmd'] in self.commands:
+                    with tracer.span('args', cmd=data['cmd']):
+                        data = self._args_from_dict(data)
+                    self.run_command(data)
+                else:
+                    raise CommandError(f"unknown command {data['cmd']}")
+            except json.JSONDecodeError:
+                self._send_error('non-json data', data)
+            except (KeyError, TypeError):
+                self._send_error('missing or invalid cmd', data)
+            except CommandError as e:
+                print(f"{self.name}: {e}")
+                self._send_error(str(e), data)
+            recorder.record(received, 'mqtt', self, recorded)
+
+    def _send_error(self, message, data):
+        # Nothing ran, so publish the unchanged status to tell the sender why
+        self.err_msg = message
+        self.prev_status = self._get_status()
+        self.req_id = data.get('req_id') if isinstance(data, dict) else None
+        status_msg = self.send_status()
+        self.req_id = None
+        return status_msg
+
+    def _mqtt_schedule(self, data):
         try:
-            data = json.loads(msg.payload)
-            if data['cmd'] in self.commands:
-                self._set_default_args_mqtt(data)
-                self.prev_status = self._get_status()
-                self.commands[data['cmd']](data)
-                self.send_status()
+            if data['cmd'] == 'schedule':
+                args = {k: v for k, v in data.items() if k not in ('cmd', 'when', 'action')}
+                args['cmd'] = data.get('action')
+                scheduler.add(self, data.get('when'), args)
             else:
-                print(f"Unknown command {data['cmd']}, ignoring")
-        except json.JSONDecodeError:
-            self.err_msg = 'non-json data'
-        except KeyError:
-            self.err_msg = 'missing or invalid cmd'
-
-    def _restore_state(self, msg):
-        data = json.loads(msg.payload)
+                try:
+                    entry_id = int(data.get('id'))
+                except (TypeError, ValueError):
+                    raise CommandError(f"invalid schedule id {data.get('id')!r}")
+                if not scheduler.cancel(entry_id, self.name):
+                    raise CommandError(f"no schedule {entry_id}")
+        finally:
+            if self.client:
+                self.client.publish(f"{self.topic}/schedule", json.dumps(scheduler.list(self.name)),
+                    qos=2, retain=True)
+
+    def _args_from_dict(self, data):
+        if data['cmd'] not in self.commands:
+            raise CommandError(f"unknown command {data['cmd']}")
+        # Internal only, never taken from a client
+        data.pop('start_time', None)
+        if data['cmd'] in self.schemas:
+            self.schemas[data['cmd']].from_dict(data)
+        return data
+
+    def _args_from_list(self, cmd, args):
+        if cmd not in self.commands:
+            raise CommandError(f"unknown command {cmd}")
+        if cmd in self.schemas:
+            return self.schemas[cmd].from_list(args)
+        return CommandSchema(cmd, []).from_list(args)
+
+    def run_command(self, data):
+        self.prev_status = self._get_status()
+        # Clients can tag a command to match it with its status
+        self.req_id = data.get('req_id')
         try:
-            if hasattr(self, 'color') and 'color' in data:
-                self.color = Color(data['color'])
-            if 'level' in data:
-                self.level = data['level']
-            if 'duration' not in data:
-                data['duration'] = 1
-            print(f"Restoring previous state of {self.name}: {data}")
-            self.fade(data)
-        except Exception as e:
-            print(f"{self.name}._restore_state({data}): {e}")
-        self._setup_complete = True
-        self.client.unsubscribe(f"{self.topic}/resp")
-
-    def _set_default_args_mqtt(self, data):
-        cmd=data['cmd']
-        if cmd in self.defaults:
-            for setting in self.defaults[cmd]:
-                name, datatype, value = setting
-                if name not in data:
-                    data[name] = datatype(value)
-
-    def _set_default_args_rest(self, data, args=[]):
-        cmd=data['cmd']
-        if cmd in self.defaults:
-            for i in range(len(self.defaults[cmd])):
-                name, datatype, value = self.defaults[cmd][i]
-                data[name] = datatype(value if args[i] == None else args[i])
-
-    def on(self):
+            with tracer.span('handler', cmd=data['cmd']):
+                self.commands[data['cmd']](data)
+            with tracer.span('send_status'):
+                status_msg = self.send_status()
+        finally:
+            self.req_id = None
+        return status_msg
+
+    def on(self, data=None):
         self.level = 1
         self.toggling = ''
         self._set_level()
 
-    def off(self):
+    def off(self, data=None):
         self.level = 0
         self.toggling = ''
         self._set_level()
@@ -177,7 +1043,8 @@ class LEDPin:
 
     def _set_level(self):
         self._log_level()
-        digitalWrite(self.pin, self.level)
+        output.digital_write(self.pin, self.level)
+        output.flush()
 
     def _log_level(self):
         print(f'{datetime.now()}: {self.name} level={self.level}')
@@ -191,6 +1058,7 @@ class LEDPin:
     def send_status(self):
         # See if status has changed
         curr_status_json = self._get_status()
+        status_stream.publish(self.name, dict(curr_status_json))
         curr_status_str = json.dumps(curr_status_json, sort_keys=True)
         prev_status_str = json.dumps(self.prev_status, sort_keys=True)
         isStateChange = True
@@ -199,14 +1067,22 @@ class LEDPin:
         curr_status_json.update({'isStateChange': isStateChange})
         if self.err_msg:
             curr_status_json.update({'error': self.err_msg})
+        if self.req_id is not None:
+            curr_status_json.update({'req_id': self.req_id})
 
         status_msg = json.dumps(curr_status_json)
-        if HAVE_MQTT:
-            self.client.publish(f"{self.topic}/resp", status_msg, qos=2, retain=True)
+        if self.client:
+            with tracer.span('publish'):
+                self.client.publish(f"{self.topic}/resp", status_msg, qos=2, retain=True)
+        for group in self.groups:
+            group._member_changed()
         return status_msg
 
 class LEDRGB(LEDPin):
     pintype = 'rgb'
+    schema = {
+        'color': [['color', str, 'black']]
+    }
 
     def __init__(self, name, pin_r, pin_g, pin_b, color):
         self.name = name
@@ -223,8 +1099,9 @@ class LEDRGB(LEDPin):
             color = 'black'
         self.color = Color(color)
         self.last_on_color = self.color if self.color.lightness > 0 else Color('white')
+        self.last_on_timer = None
         self._init_pins()
-        self._set_color(self.color)
+        self._set_color({'color': self.color})
         self._setup_cmds()
         super()._mqtt_listen()
 
@@ -233,14 +1110,11 @@ class LEDRGB(LEDPin):
         self.commands.update({
             'color': self._set_color
         })
-        self.defaults = {
-            'color': [['color', str, 'black']]
-        }
 
     def _init_pins(self):
-        pinMode(self.pins[0], OUTPUT)
-        pinMode(self.pins[1], OUTPUT)
-        pinMode(self.pins[2], OUTPUT)
+        output.setup_pin(self.pins[0])
+        output.setup_pin(self.pins[1])
+        output.setup_pin(self.pins[2])
 
     def off(self, data=None):
         self._set_color({"color": 'black'})
@@ -261,9 +1135,10 @@ class LEDRGB(LEDPin):
         self.level = 1 if self.color.lightness else 0
         self._set_last_on_timer()
         self._log_level()
-        digitalWrite(self.pins[0], int(self.color[0]))
-        digitalWrite(self.pins[1], int(self.color[1]))
-        digitalWrite(self.pins[2], int(self.color[2]))
+        output.digital_write(self.pins[0], int(self.color[0]))
+        output.digital_write(self.pins[1], int(self.color[1]))
+        output.digital_write(self.pins[2], int(self.color[2]))
+        output.flush()
 
     def _set_level(self):
         if round(self.level):
@@ -297,9 +1172,19 @@ class LEDRGB(LEDPin):
 
 class LEDPWM(LEDPin):
     pintype = 'pwm'
-    def __init__(self, name, pin, level=0):
+    schema = {
+        'downto': [['level', int,   0], ['duration', float, 1]],
+        'upto':   [['level', int, 100], ['duration', float, 1]],
+        'fade':   [['level', int,   0], ['duration', float, 1]],
+        'inc':    [['level', int,  10], ['duration', float, 0]],
+        'dec':    [['level', int,  10], ['duration', float, 0]],
+        'set':    [['level', int,   0], ['duration', float, 0]],
+        'toggle': [['duration', float, 1]]
+    }
+    def __init__(self, name, pin, level=0, listen=True):
         self.timer = None
-        super().__init__(name, pin, level)
+        self.fade_start = None
+        super().__init__(name, pin, level, listen)
         self.target = self.level
         self.target_time = 0
         self.last_on_timer = None
@@ -308,7 +1193,7 @@ class LEDPWM(LEDPin):
         #self._init_pin()
 
     def _init_pin(self):
-        pinMode(self.pin, PWM_OUTPUT)
+        output.setup_pwm(self.pin)
 
     def _def_level(self, level):
         if level == 'on':
@@ -329,17 +1214,6 @@ class LEDPWM(LEDPin):
             'set'   : self.fade
         })
 
-        # Set defaults
-        self.defaults.update({
-            'downto': [['level', int,   0], ['duration', float, 1]],
-            'upto':   [['level', int, 100], ['duration', float, 1]],
-            'fade':   [['level', int,   0], ['duration', float, 1]],
-            'inc':    [['level', int,  10], ['duration', float, 0]],
-            'dec':    [['level', int,  10], ['duration', float, 0]],
-            'set':    [['level', int,   0], ['duration', float, 0]],
-            'toggle': [['duration', float, 1]]
-        })
-
     def on(self, data={}):
         if 'level' not in data:
             data['level'] = self.last_on_level
@@ -350,26 +1224,38 @@ class LEDPWM(LEDPin):
         self.fade(data)
 
     def inc(self, data={}):
+        self._sync_level()
         data['level'] = max(min(self.level + data['level'], 100), 0)
         self.fade(data)
 
     def dec(self, data={}):
+        self._sync_level()
         data['level'] = max(min(self.level - data['level'], 100), 0)
         self.fade(data)
 
     def fade(self, data):
+        self._sync_level()
         self._stop_timer()
         self.target = max(min(data['level'], 100), 0)
         self.prev_level = self.level
-        now = datetime.now()
-        if self.level == self.target or data['duration'] == 0:
+        # Groups pass a shared start time so all members fade in step
+        now = data.get('start_time') or datetime.now()
+        self.target_time = now + timedelta(seconds=data['duration'])
+        if self.level == self.target or self.target_time <= datetime.now():
             print(f'{now}: {self.name} -- setting level from {self.level} to {self.target}')
             self.level = self.target
             self._set_level()
             self.toggling = ''
+        elif output.fades:
+            # The output process steps the fade, we only need to know when it's done
+            print(f'{now}: {self.name} -- fading from {self.level} to {data["level"]} in {data["duration"]} seconds')
+            self.fade_start = now
+            t0 = time.monotonic() + (now - datetime.now()).total_seconds()
+            self._output_fade(t0, t0 + data['duration'])
+            self.timer = Timer((self.target_time - datetime.now()).total_seconds(), self._fade_done)
+            self.timer.start()
         else:
             print(f'{now}: {self.name} -- fading from {self.level} to {data["level"]} in {data["duration"]} seconds')
-            self.target_time = now + timedelta(seconds=data['duration'])
             (step_time, step_level) = self._calc_next_step()
             self.timer = Timer(step_time, self._fade_step, {step_level})
             self.timer.start()
@@ -396,6 +1282,23 @@ class LEDPWM(LEDPin):
             self.timer.start()
         self._set_level()
 
+    def _output_fade(self, t0, t1):
+        output.pwm_fade(int(self.pin), int(self.prev_level * PWM_MAX / MAX_LEVEL),
+            int(self.target * PWM_MAX / MAX_LEVEL), t0, t1)
+        output.flush()
+
+    def _fade_done(self):
+        self.timer = None
+        self.fade_start = None
+        self._toggle_complete()
+        self._set_level()
+
+    def _sync_level(self):
+        # While the output process runs a fade, work out how far it has got
+        if self.fade_start is not None:
+            progress = (datetime.now() - self.fade_start) / (self.target_time - self.fade_start)
+            self.level = self.prev_level + (self.target - self.prev_level) * min(max(progress, 0), 1)
+
     def _toggle_complete(self):
         self.toggling = ''
         self.level = self.target
@@ -418,11 +1321,13 @@ class LEDPWM(LEDPin):
         if isinstance(self.timer, Timer):
             self.timer.cancel()
             self.timer = None
+        self.fade_start = None
 
     def _set_level(self):
         self._log_level()
         self._set_last_on_timer()
-        pwmWrite(int(self.pin), int(self.level * PWM_MAX / MAX_LEVEL))
+        output.pwm_write(int(self.pin), int(self.level * PWM_MAX / MAX_LEVEL))
+        output.flush()
 
     def _set_last_on_timer(self):
         if self.last_on_timer:
@@ -441,10 +1346,12 @@ class LEDPWM(LEDPin):
         pass
 
     def downto(self, data):
+        self._sync_level()
         if self.level > data['level']:
             self.fade(data)
 
     def upto(self, data):
+        self._sync_level()
         if self.level < data['level']:
             self.fade(data)
 
@@ -457,20 +1364,38 @@ class LEDPWM(LEDPin):
 class LEDPCA(LEDPWM):
     pintype = 'pca'
 
-    def __init__(self, name, pin=0, level=0):
-        if not HAVE_PCA:
+    def __init__(self, name, pin=0, level=0, listen=True):
+        if not output.has_pca():
             raise Exception(f"Failed to load pca9685 module required for [{name}]")
-        super().__init__(name, pin, level)
+        super().__init__(name, pin, level, listen)
 
     def _init_pin(self):
         pass
 
     def _set_level(self):
         super()._log_level()
-        pca.channels[int(self.pin)].duty_cycle = int(self.level * PCA_MAX / MAX_LEVEL)
+        output.pca_write(int(self.pin), int(self.level * PCA_MAX / MAX_LEVEL))
+        output.flush()
+
+    def _output_fade(self, t0, t1):
+        output.pca_fade(int(self.pin), int(self.prev_level * PCA_MAX / MAX_LEVEL),
+            int(self.target * PCA_MAX / MAX_LEVEL), t0, t1)
+        output.flush()
 
 class LEDPCARGB(LEDPCA):
     pintype = 'pcargb'
+    # Extra args for colors
+    schema = {
+        'inc': [['level', int, 10], ['duration', float, 0],
+            ['red', int, 0], ['green', int, 0], ['blue', int, 0]],
+        'dec': [['level', int, 10], ['duration', float, 0],
+            ['red', int, 0], ['green', int, 0], ['blue', int, 0]],
+        'color': [['color', str, 'black'], ['duration', float, 1]],
+        'hsv': [['hue', int, 0], ['saturation', int, 0],
+            ['value', int, 0], ['duration', float, 0]],
+        'set_hue': [['hue', int, 0], ['duration', float, 0]],
+        'set_sat': [['saturation', int, 0], ['duration', float, 0]]
+    }
 
     def __init__(self, name, pin_r, pin_g, pin_b, color):
         self.name = name
@@ -488,10 +1413,10 @@ class LEDPCARGB(LEDPCA):
         self.last_on_color = self.color if self.color.lightness > 0 else Color('white')
         self.last_on_timer = None
 
-        # Create 3 PCA LED's
-        self.led_r = LEDPCA(name + "_r", pin_r, self.color[0])
-        self.led_g = LEDPCA(name + "_g", pin_g, self.color[1])
-        self.led_b = LEDPCA(name + "_b", pin_b, self.color[2])
+        # Create 3 PCA LED's, driven only through this one
+        self.led_r = LEDPCA(name + "_r", pin_r, self.color[0], listen=False)
+        self.led_g = LEDPCA(name + "_g", pin_g, self.color[1], listen=False)
+        self.led_b = LEDPCA(name + "_b", pin_b, self.color[2], listen=False)
         self.led_r._notify_parent = self._update_color
         self.led_g._notify_parent = self._update_color
         self.led_b._notify_parent = self._update_color
@@ -512,19 +1437,6 @@ class LEDPCARGB(LEDPCA):
             'set_sat': self.set_sat
         })
 
-        # Extra args for colors
-        self.defaults.update({
-            'inc': [['level', int, 10], ['duration', float, 0],
-                ['red', int, 0], ['green', int, 0], ['blue', int, 0]],
-            'dec': [['level', int, 10], ['duration', float, 0],
-                ['red', int, 0], ['green', int, 0], ['blue', int, 0]],
-            'color': [['color', str, 'black'], ['duration', float, 1]],
-            'hsv': [['hue', int, 0], ['saturation', int, 0],
-                ['value', int, 0], ['duration', float, 0]],
-            'set_hue': [['hue', int, 0], ['duration', float, 0]],
-            'set_sat': [['saturation', int, 0], ['duration', float, 0]]
-        })
-
     def _set_color(self, data):
         try:
             self.color = Color(data['color'])
@@ -578,26 +1490,31 @@ class LEDPCARGB(LEDPCA):
         self.fade(data)
 
     def on(self, data):
-        self.fade({'color': self.last_on_color.html, 'duration': data['duration']})
+        self.fade({'color': self.last_on_color.html, 'duration': data['duration'],
+            'start_time': data.get('start_time')})
 
     def off(self, data):
-        self.fade({'color': 'black', 'duration': data['duration']})
+        self.fade({'color': 'black', 'duration': data['duration'],
+            'start_time': data.get('start_time')})
 
     def fade(self, data={}):
-        self._update_color()
+        with tracer.span('color'):
+            self._update_color()
         defaults = {'red': 0, 'green': 0, 'blue': 0, 'color': 'black', 'level': 0}
         defaults.update(data)
         data = defaults
         if data['color'] and not data['level'] and not data['red'] and not data['green'] and not data['blue']:
-            r,g,b = Color(data['color'])
+            with tracer.span('color'):
+                r,g,b = Color(data['color'])
             data['red']   = r*100
             data['green'] = g*100
             data['blue']  = b*100
         elif data['level'] and not data['red'] and not data['green'] and not data['blue']:
             data['red'] = data['green'] = data['blue'] = data['level']
-        self.led_r.fade({'level': data['red'],   'duration': data['duration']})
-        self.led_g.fade({'level': data['green'], 'duration': data['duration']})
-        self.led_b.fade({'level': data['blue'],  'duration': data['duration']})
+        start_time = data.get('start_time') or datetime.now()
+        self.led_r.fade({'level': data['red'],   'duration': data['duration'], 'start_time': start_time})
+        self.led_g.fade({'level': data['green'], 'duration': data['duration'], 'start_time': start_time})
+        self.led_b.fade({'level': data['blue'],  'duration': data['duration'], 'start_time': start_time})
         self.color = Color(
             self.led_r.target/100,
             self.led_g.target/100,
@@ -626,7 +1543,8 @@ class LEDPCARGB(LEDPCA):
 
     def set_color(self, data=None):
         try:
-            self.color = Color(data['color'])
+            with tracer.span('color'):
+                self.color = Color(data['color'])
         except Exception:
             self.color = Color('black')
             self.err_msg = 'Invalid color, using black instead'
@@ -634,11 +1552,12 @@ class LEDPCARGB(LEDPCA):
 
     def set_hsv(self, data=None):
         try:
-            self.color = Color(
-                h=data['hue']/100,
-                s=data['saturation']/100,
-                v=data['value']/100
-            )
+            with tracer.span('color'):
+                self.color = Color(
+                    h=data['hue']/100,
+                    s=data['saturation']/100,
+                    v=data['value']/100
+                )
         except Exception:
             self.color = Color('black')
             self.err_msg = 'Invalid color, using black instead'
@@ -667,10 +1586,13 @@ class LEDPCARGB(LEDPCA):
             'red'  : self.color[0]*100,
             'green': self.color[1]*100,
             'blue' : self.color[2]*100,
-            'duration': data['duration']
+            'duration': data['duration'],
+            'start_time': data.get('start_time')
         })
 
     def _update_color(self):
+        for led in (self.led_r, self.led_g, self.led_b):
+            led._sync_level()
         self.color = Color(
             self.led_r.level/100,
             self.led_g.level/100,
@@ -690,13 +1612,732 @@ class LEDPCARGB(LEDPCA):
             'switch': 'on' if self.color.lightness else 'off'
         }
 
+class LEDPixels(LEDPin):
+    pintype = 'pixels'
+    schema = {
+        'on'    : [['duration', float, 1], ['first', int, 0], ['last', int, -1]],
+        'off'   : [['duration', float, 1], ['first', int, 0], ['last', int, -1]],
+        'toggle': [['duration', float, 1]],
+        'fade'  : [['level', int, 0], ['duration', float, 1], ['first', int, 0], ['last', int, -1]],
+        'color' : [['color', str, 'black'], ['duration', float, 1], ['first', int, 0], ['last', int, -1]],
+        'hsv'   : [['hue', int, 0], ['saturation', int, 0], ['value', int, 0],
+            ['duration', float, 0], ['first', int, 0], ['last', int, -1]]
+    }
+
+    def __init__(self, name, count, chip, color, bus=0, device=0, speed=None, spi=None):
+        self.name = name
+        if not HAVE_PIXELS:
+            raise Exception(f"Failed to load numpy module required for [{name}]")
+        if count == None:
+            raise Exception(f"[{name}] missing pixel count")
+        if chip not in ('ws2812', 'apa102'):
+            raise Exception(f"[{name}] unknown chip '{chip}'")
+        self.count = int(count)
+        self.chip = chip
+        if color == 'on':
+            color = 'white'
+        elif color == 'off':
+            color = 'black'
+        self.color = Color(color)
+        self.last_on_color = self.color if self.color.lightness > 0 else Color('white')
+        self.base_color = self.last_on_color
+        self.last_on_timer = None
+        self.timer = None
+        self.toggling = ''
+        self.err_msg = None
+
+        # Framebuffer and fade endpoints, RGB 0-1 per pixel
+        self.frame = np.zeros((self.count, 3))
+        self.fade_from = np.zeros((self.count, 3))
+        self.fade_to = np.zeros((self.count, 3))
+        self.fade_start = None
+        self.fade_duration = 0
+        self.scaled = np.zeros((self.count, 3))
+        self._init_spi(spi, bus, device, speed)
+        self._setup_cmds()
+        self._fade_segment(self.color, {'duration': 0, 'first': 0, 'last': -1})
+        super()._mqtt_listen()
+
+    def _init_spi(self, spi, bus, device, speed):
+        # Wire format goes straight into one reusable buffer
+        if self.chip == 'ws2812':
+            self.spibuf = np.zeros(self.count * 9 + WS2812_RESET_BYTES, np.uint8)
+            self.wire = self.spibuf[:self.count * 9].reshape(self.count * 3, 3)
+            self.bytes = np.zeros((self.count, 3), np.uint8)
+            self.channels = (1, 0, 2)   # GRB
+        else:
+            self.spibuf = np.zeros(4 + self.count * 4 + max(4, (self.count + 15) // 16), np.uint8)
+            self.spibuf[4 + self.count * 4:] = 0xFF
+            self.wire = self.spibuf[4:4 + self.count * 4].reshape(self.count, 4)
+            self.wire[:, 0] = 0xFF      # Full global brightness
+            self.bytes = self.wire[:, 1:]
+            self.channels = (2, 1, 0)   # BGR
+        if spi is None:
+            if not HAVE_SPI:
+                raise Exception(f"Failed to load spidev module required for [{self.name}]")
+            spi = spidev.SpiDev()
+            spi.open(bus, device)
+            spi.mode = 0
+            spi.max_speed_hz = speed or (WS2812_SPI_SPEED if self.chip == 'ws2812' else APA102_SPI_SPEED)
+        self.spi = spi
+
+    def _setup_cmds(self):
+        super()._setup_cmds()
+        self.commands.update({
+            'color': self.set_color,
+            'hsv'  : self.set_hsv
+        })
+
+    def on(self, data={}):
+        self._fade_segment(self.last_on_color, data)
+
+    def off(self, data={}):
+        self._fade_segment(Color('black'), data)
+
+    def toggle(self, data={}):
+        data.update({'first': 0, 'last': -1})
+        if self.toggling == 'on' or (self.toggling != 'off' and self.fade_to.any()):
+            self.toggling = 'off'
+            self.off(data)
+        else:
+            self.toggling = 'on'
+            self.on(data)
+
+    def fade(self, data):
+        # Always dims the undimmed color, so fading back up gets full brightness
+        r, g, b = self.base_color
+        level = max(min(data['level'], 100), 0) / 100
+        self._fade_segment(Color(r * level, g * level, b * level), data, remember=False)
+
+    def set_color(self, data):
+        try:
+            color = Color(data['color'])
+        except Exception:
+            color = Color('black')
+            self.err_msg = 'Invalid color, using black instead'
+        self._fade_segment(color, data)
+
+    def set_hsv(self, data):
+        try:
+            color = Color(h=data['hue']/100, s=data['saturation']/100, v=data['value']/100)
+        except Exception:
+            color = Color('black')
+            self.err_msg = 'Invalid color, using black instead'
+        self._fade_segment(color, data)
+
+    def _fade_segment(self, color, data, remember=True):
+        first = data.get('first', 0)
+        last = data.get('last', -1)
+        if last == -1:
+            last = self.count - 1
+        if not 0 <= first <= last < self.count:
+            raise CommandError(f"invalid pixel range first={first} last={data.get('last', -1)} "
+                f"for {self.count} pixels")
+        self._stop_timer()
+        segment = slice(first, last + 1)
+        self.color = color
+        if remember and color.lightness:
+            self.base_color = color
+            self._set_last_on_timer(color)
+        np.copyto(self.fade_from, self.frame)
+        self.fade_to[segment] = tuple(color)
+        self.fade_start = data.get('start_time') or datetime.now()
+        self.fade_duration = data['duration']
+        print(f'{self.fade_start}: {self.name} -- fading pixels {first}-{last} to {color.html} in {self.fade_duration} seconds')
+        self._fade_step()
+
+    def _fade_step(self):
+        if self.fade_duration:
+            progress = (datetime.now() - self.fade_start).total_seconds() / self.fade_duration
+        else:
+            progress = 1
+        if progress >= 1:
+            np.copyto(self.frame, self.fade_to)
+            self.toggling = ''
+            self.timer = None
+        else:
+            self._blend(max(progress, 0))
+            self.timer = Timer(MIN_STEP_TIME, self._fade_step)
+            self.timer.start()
+        self._render()
+
+    def _blend(self, progress):
+        # frame = from + (to - from) * progress, for the whole strip at once
+        np.subtract(self.fade_to, self.fade_from, out=self.frame)
+        self.frame *= progress
+        self.frame += self.fade_from
+
+    def _render(self):
+        for i, channel in enumerate(self.channels):
+            np.multiply(self.frame[:, channel], 255, out=self.scaled[:, i])
+        np.rint(self.scaled, out=self.scaled)
+        np.copyto(self.bytes, self.scaled, casting='unsafe')
+        if self.chip == 'ws2812':
+            np.take(WS2812_TABLE, self.bytes.ravel(), axis=0, out=self.wire, mode='clip')
+        with tracer.span('spi_write', bytes=len(self.spibuf)):
+            self.spi.writebytes2(self.spibuf)
+
+    def _stop_timer(self):
+        if isinstance(self.timer, Timer):
+            self.timer.cancel()
+            self.timer = None
+
+    def _set_last_on_timer(self, color):
+        if self.last_on_timer:
+            self.last_on_timer.cancel()
+        self.last_on_timer = Timer(2, self._set_last_on, [color])
+        self.last_on_timer.start()
+
+    def _set_last_on(self, color):
+        self.last_on_color = color
+        self.last_on_timer = None
+
+    def _get_status(self):
+        # The whole strip's average, which is just its color when all pixels match
+        color = Color(*self.fade_to.mean(axis=0))
+        return {
+            'color' : color.html,
+            'level' : color.lightness,
+            'switch': 'on' if self.fade_to.any() else 'off'
+        }
+
+def _ws2812_table():
+    # Each data bit becomes 3 SPI bits: 1 = 110, 0 = 100
+    table = np.zeros((256, 3), np.uint8)
+    for value in range(256):
+        bits = 0
+        for bit in range(7, -1, -1):
+            bits = bits << 3 | (0b110 if value >> bit & 1 else 0b100)
+        table[value] = (bits >> 16, bits >> 8 & 0xFF, bits & 0xFF)
+    return table
+
+if HAVE_PIXELS:
+    WS2812_TABLE = _ws2812_table()
+
+class LEDGroup(LEDPin):
+    pintype = 'group'
+    schema = {
+        'on'    : [['duration', float, 1]],
+        'off'   : [['duration', float, 1]],
+        'toggle': [['duration', float, 1]],
+        'fade'  : [['level', int, 0], ['duration', float, 1]],
+        'inc'   : [['level', int, 10], ['duration', float, 0]],
+        'dec'   : [['level', int, 10], ['duration', float, 0]],
+        'color' : [['color', str, 'black'], ['duration', float, 1]]
+    }
+
+    def __init__(self, name, members):
+        self.name = name
+        if not members:
+            raise Exception(f"[{name}] group has no members")
+        self.members = members
+        for led in self.members:
+            led.groups = led.groups + (self,)
+        self.level = 0
+        self.last_on_timer = None
+        self.toggling = ''
+        self.err_msg = None
+        self._fanning_out = False
+        self._setup_cmds()
+        self.prev_status = self._get_status()
+        super()._mqtt_listen()
+
+    def _setup_cmds(self):
+        super()._setup_cmds()
+        self.commands.update({
+            'inc'  : self.inc,
+            'dec'  : self.dec,
+            'color': self.set_color
+        })
+
+    def on(self, data={}):
+        self._fan_out('on', data)
+
+    def off(self, data={}):
+        self._fan_out('off', data)
+
+    def toggle(self, data={}):
+        self._fan_out('off' if self._get_status()['switch'] == 'on' else 'on', data)
+
+    def fade(self, data):
+        self._fan_out('fade', data)
+
+    def inc(self, data={}):
+        self._fan_out('inc', data)
+
+    def dec(self, data={}):
+        self._fan_out('dec', data)
+
+    def set_color(self, data):
+        try:
+            data['value'] = Color(data['color']).hsv[2] * 100
+        except Exception:
+            data['color'] = 'black'
+            data['value'] = 0
+            self.err_msg = 'Invalid color, using black instead'
+        self._fan_out('color', data)
+
+    def _fan_out(self, cmd, data):
+        # Work out every member's command before touching any hardware
+        if cmd == 'inc':
+            data['group_level'] = min(self._get_status()['level'] + data['level'], 100)
+        elif cmd == 'dec':
+            data['group_level'] = max(self._get_status()['level'] - data['level'], 0)
+        plan = []
+        for led in self.members:
+            plan.append((led, led._args_from_dict(self._translate(led, cmd, data))))
+
+        # Then start them all against the same clock
+        start_time = data.get('start_time') or datetime.now()
+        print(f'{start_time}: {self.name} -- {cmd} on {len(plan)} members')
+        self._fanning_out = True
+        try:
+            for led, member_data in plan:
+                led.err_msg = None
+                led.prev_status = led._get_status()
+                member_data['start_time'] = start_time
+            for led, member_data in plan:
+                led.commands[member_data['cmd']](member_data)
+            for led, member_data in plan:
+                led.send_status()
+        finally:
+            self._fanning_out = False
+
+    def _translate(self, led, cmd, data):
+        dimmable = isinstance(led, LEDPWM)
+        if cmd in ('on', 'off'):
+            return {'cmd': cmd, 'duration': data['duration']}
+        elif cmd == 'fade':
+            if dimmable or isinstance(led, LEDPixels):
+                return {'cmd': 'fade', 'level': data['level'], 'duration': data['duration']}
+            level = data['level']
+        elif cmd in ('inc', 'dec'):
+            if dimmable:
+                return {'cmd': cmd, 'level': data['level'], 'duration': data['duration']}
+            if isinstance(led, LEDPixels):
+                return {'cmd': 'fade', 'level': data['group_level'], 'duration': data['duration']}
+            level = data['group_level']
+        elif cmd == 'color':
+            if 'color' in led.commands:
+                return {'cmd': 'color', 'color': data['color'], 'duration': data['duration']}
+            if dimmable:
+                return {'cmd': 'fade', 'level': data['value'], 'duration': data['duration']}
+            level = data['value']
+        return {'cmd': 'on' if level else 'off', 'duration': data['duration']}
+
+    def _member_level(self, led):
+        if hasattr(led, 'color'):
+            return led.color.lightness * 100
+        elif isinstance(led, LEDPWM):
+            return led.target
+        return led.level * 100
+
+    def _member_changed(self):
+        # A member was changed directly, let subscribers know the group changed too
+        if not self._fanning_out:
+            self.err_msg = None
+            self.send_status()
+
+    def send_status(self):
+        status_msg = super().send_status()
+        self.prev_status = self._get_status()
+        return status_msg
+
+    def _get_status(self):
+        levels = [self._member_level(led) for led in self.members]
+        return {
+            'level'  : max(levels),
+            'switch' : 'on' if max(levels) else 'off',
+            'members': {led.name: 'on' if level else 'off' for led, level in zip(self.members, levels)}
+        }
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(text):
+    # e.g. 90, 90s, 2h, 1h30m
+    if not re.fullmatch(r'(\d+(\.\d+)?[smhd]?)+', text):
+        raise ValueError(f"bad duration '{text}'")
+    return sum(float(number) * DURATION_UNITS[unit or 's']
+        for number, unit in re.findall(r'(\d+(?:\.\d+)?)([smhd]?)', text))
+
+def _cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-'))
+        else:
+            start = int(part)
+            end = high if step else start
+        values.update(range(start, end + 1, int(step) if step else 1))
+    if not values or min(values) < low or max(values) > high:
+        raise ValueError(f"bad cron field '{field}'")
+    return values
+
+def next_cron(spec, after):
+    # Standard 5-field cron: minute hour day-of-month month day-of-week (0 or 7 = Sunday)
+    fields = spec.replace('_', ' ').split()
+    if len(fields) != 5:
+        raise ValueError('cron needs 5 fields')
+    minutes = sorted(_cron_field(fields[0], 0, 59))
+    hours = sorted(_cron_field(fields[1], 0, 23))
+    days = _cron_field(fields[2], 1, 31)
+    months = _cron_field(fields[3], 1, 12)
+    weekdays = {d % 7 for d in _cron_field(fields[4], 0, 7)}
+    either_day = fields[2] != '*' and fields[4] != '*'
+
+    start = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = start.replace(hour=0, minute=0)
+    for _ in range(5 * 366):
+        dom_ok = day.day in days
+        dow_ok = (day.weekday() + 1) % 7 in weekdays
+        if day.month in months and ((dom_ok or dow_ok) if either_day else (dom_ok and dow_ok)):
+            for hour in hours:
+                for minute in minutes:
+                    candidate = day.replace(hour=hour, minute=minute)
+                    if candidate >= start:
+                        return candidate.timestamp()
+        day += timedelta(days=1)
+    raise ValueError('cron never matches')
+
+def sun_time(day, latitude, longitude, event):
+    # Sunrise equation, see https://en.wikipedia.org/wiki/Sunrise_equation
+    # Returns unix time of 'sunrise' or 'sunset' on day, None if there isn't one
+    j_star = (day - date(2000, 1, 1)).days - longitude / 360
+    m = (357.5291 + 0.98560028 * j_star) % 360
+    c = 1.9148 * math.sin(math.radians(m)) + 0.02 * math.sin(math.radians(2 * m)) \
+        + 0.0003 * math.sin(math.radians(3 * m))
+    ecliptic = math.radians((m + c + 180 + 102.9372) % 360)
+    j_transit = 2451545.0 + j_star + 0.0053 * math.sin(math.radians(m)) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    cos_hour_angle = (math.sin(math.radians(-0.833))
+        - math.sin(math.radians(latitude)) * math.sin(declination)) \
+        / (math.cos(math.radians(latitude)) * math.cos(declination))
+    if not -1 <= cos_hour_angle <= 1:
+        return None
+    hour_angle = math.degrees(math.acos(cos_hour_angle)) / 360
+    julian = j_transit - hour_angle if event == 'sunrise' else j_transit + hour_angle
+    return (julian - 2440587.5) * 86400
+
+# One heap of timed commands for all LEDs, run by a single thread that
+# sleeps until the next one is due.  Entries are saved to a file so they
+# survive a restart.
+class Scheduler:
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+        self.next_id = 1
+        self.changed = Condition()
+        self.file = None
+        self.latitude = None
+        self.longitude = None
+
+    def configure(self, section):
+        self.file = section.get('file', SCHEDULE_FILE)
+        if 'latitude' in section and 'longitude' in section:
+            self.latitude = section.getfloat('latitude')
+            self.longitude = section.getfloat('longitude')
+
+    def next_due(self, when, after):
+        # Returns (unix time, recurring)
+        kind = when.lower()
+        try:
+            # An unescaped + in a URL arrives as a space and gets stripped
+            if kind.startswith('+') or kind[:1].isdigit():
+                return after + parse_duration(kind.lstrip('+')), False
+            elif kind.startswith('at:'):
+                return self._next_at(when[3:], after), False
+            elif kind.startswith('cron:'):
+                return next_cron(when[5:], after), True
+            elif kind.startswith(('sunrise', 'sunset')):
+                return self._next_sun(kind, after), True
+        except ValueError as e:
+            raise CommandError(f"invalid time '{when}': {e}")
+        raise CommandError(f"invalid time '{when}'")
+
+    def _next_at(self, text, after):
+        if '-' in text:
+            due = datetime.fromisoformat(text).timestamp()
+            if due <= after:
+                raise ValueError('that time has passed')
+            return due
+        # Only a time of day, use the next one
+        time_format = '%H:%M' if text.count(':') == 1 else '%H:%M:%S'
+        at = datetime.combine(date.fromtimestamp(after), datetime.strptime(text, time_format).time())
+        if at.timestamp() <= after:
+            at += timedelta(days=1)
+        return at.timestamp()
+
+    def _next_sun(self, when, after):
+        match = re.fullmatch(r'(sunrise|sunset)(?:([+-])(.+))?', when)
+        if not match:
+            raise ValueError('use sunrise or sunset, optionally followed by +/- a duration')
+        if self.latitude is None:
+            raise ValueError('set latitude and longitude in [schedule] first')
+        event, sign, offset = match.groups()
+        offset = parse_duration(offset) * (-1 if sign == '-' else 1) if offset else 0
+        day = date.fromtimestamp(after)
+        for _ in range(367):
+            sun = sun_time(day, self.latitude, self.longitude, event)
+            if sun is not None and sun + offset > after:
+                return sun + offset
+            day += timedelta(days=1)
+        raise ValueError(f'no {event} here')
+
+    def add(self, led, when, data):
+        when = (when or '').strip()
+        data = led._args_from_dict(dict(data))
+        due, recurring = self.next_due(when, time.time())
+        with self.changed:
+            entry = {'id': self.next_id, 'led': led.name, 'when': when, 'due': due,
+                'recurring': recurring, 'args': data}
+            self.next_id += 1
+            self.entries[entry['id']] = entry
+            heapq.heappush(self.heap, (due, entry['id']))
+            self.changed.notify()
+            self._save()
+            print(f"{datetime.now()}: scheduled {led.name} {data['cmd']} {when} (id {entry['id']})")
+            return self._describe(entry)
+
+    def add_at(self, led, due, data, apply_at):
+        # One-shot for a cluster command, only kept in memory
+        data = led._args_from_dict(dict(data))
+        with self.changed:
+            entry = {'id': self.next_id, 'led': led.name, 'when': 'apply_at', 'due': due,
+                'recurring': False, 'args': data, 'apply_at': apply_at}
+            self.next_id += 1
+            self.entries[entry['id']] = entry
+            heapq.heappush(self.heap, (due, entry['id']))
+            self.changed.notify()
+            return entry['id']
+
+    def cancel(self, entry_id, name=None):
+        with self.changed:
+            entry = self.entries.get(entry_id)
+            if entry is None or (name is not None and entry['led'] != name):
+                return False
+            del self.entries[entry_id]
+            # Take it out of the queue too, or repeated add/cancel would grow it forever
+            self.heap = [queued for queued in self.heap if queued[1] != entry_id]
+            heapq.heapify(self.heap)
+            self.changed.notify()
+            self._save()
+            return True
+
+    def list(self, name=None):
+        with self.changed:
+            return [self._describe(entry) for entry in sorted(self.entries.values(), key=lambda e: e['due'])
+                if (name is None or entry['led'] == name) and 'apply_at' not in entry]
+
+    def _describe(self, entry):
+        described = dict(entry)
+        described['next'] = datetime.fromtimestamp(entry['due']).isoformat(timespec='seconds')
+        return described
+
+    def run(self):
+        while True:
+            due = []
+            with self.changed:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    when, entry_id = heapq.heappop(self.heap)
+                    entry = self.entries.get(entry_id)
+                    if entry is None or entry['due'] != when:
+                        # Cancelled or rescheduled since this was queued
+                        continue
+                    due.append(entry)
+                    if entry['recurring']:
+                        self._reschedule(entry, now)
+                    else:
+                        del self.entries[entry_id]
+                if due:
+                    self._save()
+                else:
+                    self.changed.wait(min(self.heap[0][0] - now, SCHEDULE_MAX_WAIT) if self.heap else None)
+            for entry in due:
+                self._fire(entry)
+
+    def _reschedule(self, entry, now):
+        try:
+            entry['due'] = self.next_due(entry['when'], now)[0]
+            heapq.heappush(self.heap, (entry['due'], entry['id']))
+        except CommandError as e:
+            print(f"Dropping schedule {entry['id']}: {e}")
+            del self.entries[entry['id']]
+
+    def _fire(self, entry):
+        led = leds.get(entry['led'])
+        if led is None:
+            print(f"Schedule {entry['id']}: unknown led {entry['led']}, ignoring")
+            return
+        print(f"{datetime.now()}: schedule {entry['id']} -- {entry['led']} {entry['args']['cmd']}")
+        with tracer.command(led.name, 'schedule'):
+            try:
+                led.err_msg = None
+                args = led._args_from_dict(dict(entry['args']))
+                if 'apply_at' in entry:
+                    # Fades run from the agreed moment, however late this thread got here
+                    args['start_time'] = datetime.fromtimestamp(entry['due'])
+                    cluster.report(led, entry['apply_at'], args.get('req_id'))
+                led.run_command(args)
+            except Exception as e:
+                print(f"Schedule {entry['id']}: {e}")
+
+    def _save(self):
+        if not self.file:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with open(self.file + '.tmp', 'w') as f:
+                json.dump({'next_id': self.next_id,
+                    'entries': [entry for entry in self.entries.values() if 'apply_at' not in entry]}, f)
+            os.replace(self.file + '.tmp', self.file)
+        except OSError as e:
+            print(f"Failed to save schedule to {self.file}: {e}")
+
+    def load(self):
+        try:
+            with open(self.file) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Failed to load schedule from {self.file}: {e}")
+            return
+        now = time.time()
+        with self.changed:
+            self.next_id = saved.get('next_id', 1)
+            for entry in saved.get('entries', []):
+                if entry['led'] not in leds:
+                    print(f"Dropping schedule {entry['id']}: unknown led {entry['led']}")
+                    continue
+                self.entries[entry['id']] = entry
+                if entry['recurring']:
+                    self._reschedule(entry, now)
+                else:
+                    # One-shots missed while we were down run straight away
+                    heapq.heappush(self.heap, (entry['due'], entry['id']))
+            print(f"Loaded {len(self.entries)} scheduled commands from {self.file}")
+
+scheduler = Scheduler()
+
+class ClusterSync:
+    # Several controllers sharing one clock, taken from the master node
+    def __init__(self):
+        self.client = None
+        self.node = socket.gethostname()
+        self.master = False
+        self.offset = 0.0   # master clock - our clock, in seconds
+        self.rtt = None
+        self.samples = deque(maxlen=CLUSTER_SAMPLES)
+        self.applied = deque(maxlen=CLUSTER_APPLIED)
+        self.lock = Lock()
+
+    def configure(self, section):
+        self.node = section.get('node', self.node)
+        self.master = section.getboolean('master', False)
+        self.topic = section.get('topic', 'cluster')
+        self.lead = section.getfloat('lead', CLUSTER_LEAD)
+        self.interval = section.getfloat('sync_interval', CLUSTER_SYNC_INTERVAL)
+
+    def start(self):
+        # parse_config() fills in a default [mqtt], so look for lights that actually use it
+        if not any(led.client for led in leds.values()):
+            print("[cluster] needs MQTT, running without a shared clock")
+            return
+        self.client = mqtt.Client()
+        self.client.on_connect = self._connect
+        self.client.on_message = self._message
+        self.client.connect(config['mqtt'].get('broker', 'mqtt-broker'))
+        self.client.loop_start()
+        if not self.master:
+            Thread(target=self._ping_loop, daemon=True).start()
+
+    def now(self):
+        return time.time() + self.offset
+
+    def _connect(self, client, userdata, flags, rc):
+        print(f"Cluster node {self.node}{' (master)' if self.master else ''} on topic {self.topic}")
+        client.subscribe(f"{self.topic}/apply/+")
+        if self.master:
+            client.subscribe(f"{self.topic}/ping")
+            client.subscribe(f"cmd/{self.topic}/+/req")
+        else:
+            client.subscribe(f"{self.topic}/pong/{self.node}")
+
+    def _message(self, client, userdata, msg):
+        received = time.time()
+        try:
+            data = json.loads(msg.payload)
+            if msg.topic == f"{self.topic}/ping":
+                data['t1'] = time.time()
+                client.publish(f"{self.topic}/pong/{data['node']}", json.dumps(data))
+            elif msg.topic.startswith(f"{self.topic}/pong/"):
+                self._pong(data, received)
+            elif msg.topic.startswith(f"{self.topic}/apply/"):
+                led = leds.get(msg.topic.split('/')[-1])
+                if led is not None:
+                    self.apply(led, data)
+            else:
+                # A command for the whole cluster: stamp it and pass it on to every node
+                name = msg.topic.split('/')[-2]
+                data.setdefault('apply_at', self.now() + self.lead)
+                client.publish(f"{self.topic}/apply/{name}", json.dumps(data), qos=2)
+        except (ValueError, KeyError, TypeError, CommandError) as e:
+            print(f"Cluster: bad message on {msg.topic}: {e}")
+
+    def _ping_loop(self):
+        # A quick burst for a first estimate, then keep it fresh
+        for i in range(CLUSTER_SAMPLES // 2):
+            self._ping()
+            time.sleep(0.1)
+        while True:
+            time.sleep(self.interval)
+            self._ping()
+
+    def _ping(self):
+        self.client.publish(f"{self.topic}/ping", json.dumps({'node': self.node, 't0': time.time()}))
+
+    def _pong(self, data, received):
+        rtt = received - data['t0']
+        self.samples.append((rtt, data['t1'] - (data['t0'] + received) / 2))
+        # The fastest round trip is the least skewed by queueing in the broker
+        self.rtt, self.offset = min(self.samples)
+
+    def apply(self, led, data):
+        try:
+            apply_at = float(data.pop('apply_at'))
+        except (TypeError, ValueError):
+            raise CommandError('apply_at must be a unix time')
+        if not math.isfinite(apply_at):
+            raise CommandError('apply_at must be a unix time')
+        # A broker may deliver the same command twice, the second must not run it again
+        with self.lock:
+            if (led.name, apply_at) in self.applied:
+                print(f"Cluster: dropping repeated command for {led.name} at {apply_at}")
+                return
+            self.applied.append((led.name, apply_at))
+        scheduler.add_at(led, apply_at - self.offset, data, apply_at)
+
+    def report(self, led, apply_at, req_id):
+        started = self.now()
+        if self.client:
+            self.client.publish(f"{self.topic}/skew", json.dumps({'node': self.node, 'led': led.name,
+                'req_id': req_id, 'apply_at': apply_at, 'started': started, 'late': started - apply_at,
+                'offset': self.offset, 'rtt': self.rtt}))
+
+cluster = ClusterSync()
+
 if HAVE_REST:
     app = Flask(__name__)
 
 def parse_config():
     if config.sections():
+        groups = []
         for section in config.sections():
-            if section == 'mqtt' or section == 'rest':
+            if section in SERVICE_SECTIONS:
                 continue
             level = config[section].get('default', 'off').lower()
             pintype = config[section].get('type', 'onoff').lower()
@@ -723,8 +2364,30 @@ def parse_config():
                     config[section]['blue'],
                     config[section].get('default', 'black').lower()
                 )
+            elif pintype == 'pixels':
+                leds[section] = LEDPixels(section,
+                    config[section].get('count', None),
+                    config[section].get('chip', 'ws2812').lower(),
+                    config[section].get('default', 'black').lower(),
+                    int(config[section].get('spi_bus', 0)),
+                    int(config[section].get('spi_device', 0)),
+                    int(config[section]['speed']) if 'speed' in config[section] else None
+                )
+            elif pintype == 'group':
+                # Members may be defined further down, so build groups last
+                groups.append(section)
             else:
                 raise Exception(f"[{section}] unknown pin type '{pintype}'")
+        for section in groups:
+            members = []
+            for member in config[section].get('members', '').split(','):
+                member = member.strip()
+                if not member:
+                    continue
+                if member not in leds or isinstance(leds[member], LEDGroup):
+                    raise Exception(f"[{section}] unknown member '{member}'")
+                members.append(leds[member])
+            leds[section] = LEDGroup(section, members)
         if 'mqtt' not in config.sections():
             config['mqtt'] = {'topic': 'led', 'broker': 'mqtt-broker'}
         if 'rest' not in config.sections():
@@ -733,48 +2396,278 @@ def parse_config():
         # Default to using a single PWM LED on pin 18
         leds['led'] = LEDPWM('led', PWM_PIN, 0)
 
+    # Initial state for status stream clients
+    for name, led in leds.items():
+        status_stream.publish(name, led._get_status())
+
+def restore_states():
+    # Fetch every light's last status from the broker in one pass, then
+    # set them all at once before taking any commands
+    started = time.monotonic()
+    listening = [led for led in leds.values() if led.client]
+    expected = {led.name for led in listening if not isinstance(led, LEDGroup)}
+    states = {}
+    if expected:
+        broker = config['mqtt'].get('broker', 'mqtt-broker')
+        timeout = config['mqtt'].getfloat('restore_timeout', RESTORE_TIMEOUT)
+        done = Event()
+
+        def on_connect(client, userdata, flags, rc):
+            client.subscribe(f"cmd/{config['mqtt'].get('topic', 'led')}/+/resp")
+
+        def on_message(client, userdata, msg):
+            name = msg.topic.split('/')[-2]
+            if not msg.retain or name not in expected:
+                return
+            try:
+                states[name] = json.loads(msg.payload)
+            except ValueError:
+                print(f"Ignoring saved state of {name}: {msg.payload}")
+            if expected <= states.keys():
+                done.set()
+
+        client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_message = on_message
+        try:
+            client.connect(broker)
+            client.loop_start()
+            done.wait(timeout)
+            client.loop_stop()
+            client.disconnect()
+        except OSError as e:
+            print(f"Failed to fetch saved states from {broker}: {e}")
+
+    # Anything without a usable saved state keeps its default from the config file
+    plan = []
+    for name, status in dict(states).items():
+        led = leds[name]
+        if 'color' in status and 'color' in led.commands:
+            data = {'cmd': 'color', 'color': status['color']}
+        elif 'level' in status:
+            data = {'cmd': 'fade', 'level': status['level']}
+        else:
+            continue
+        data['duration'] = RESTORE_DURATION
+        try:
+            plan.append((led, led._args_from_dict(data)))
+        except CommandError as e:
+            print(f"Not restoring {name}: {e}")
+
+    start_time = datetime.now()
+    for led, data in plan:
+        led.err_msg = None
+        led.prev_status = led._get_status()
+        data['start_time'] = start_time
+        led.commands[data['cmd']](data)
+    for led, data in plan:
+        led.send_status()
+    print(f"Restored {len(plan)} of {len(expected)} lights in {time.monotonic() - started:.3f}s")
+
+    for led in listening:
+        led._setup_complete = True
+        led._mqtt_subscribe()
+
 def rest_listen():
     base_url = config['rest'].get('base', '')
     if base_url:
         base_url = '/' + base_url
 
+    def error_response(led, e, data):
+        # Same status body as MQTT gets, with the reason in 'error'
+        print(f"{led.name}: {e}")
+        return Response(led._send_error(str(e), data), status=400, mimetype='application/json')
+
     @app.route(base_url + '/<name>/<func>', methods=['GET'])
-    @app.route(base_url + '/<name>/<func>/<argone>', methods=['GET'])
-    @app.route(base_url + '/<name>/<func>/<argone>/<argtwo>', methods=['GET'])
-    def dispatch(name, func, argone=None, argtwo=None):
+    @app.route(base_url + '/<name>/<func>/<path:args>', methods=['GET'])
+    def dispatch(name, func, args=''):
+        received = time.time()
         if name in leds:
             led = leds[name]
             if func in led.commands:
-                data = {'cmd': func}
-                led._set_default_args_rest(data, [argone, argtwo])
-                led.prev_status = led._get_status()
-                led.commands[func](data)
-                return led.send_status()
+                led.err_msg = None
+                with tracer.command(name, 'rest'):
+                    data = None
+                    try:
+                        with tracer.span('args', cmd=func):
+                            data = led._args_from_list(func, args.split('/') if args else [])
+                        recorded = recorder.copy(data)
+                        status_msg = led.run_command(data)
+                    except CommandError as e:
+                        return error_response(led, e, data)
+                    recorder.record(received, 'rest', led, recorded)
+                return status_msg
             else:
                 abort(404)
         else:
             abort(404)
+
+    @app.route(base_url + '/schedule', methods=['GET'])
+    @app.route(base_url + '/<name>/schedule', methods=['GET'])
+    def schedule_list(name=None):
+        if name is not None and name not in leds:
+            abort(404)
+        return Response(json.dumps(scheduler.list(name)), mimetype='application/json')
+
+    @app.route(base_url + '/<name>/schedule/<func>', methods=['GET'])
+    @app.route(base_url + '/<name>/schedule/<func>/<path:args>', methods=['GET'])
+    def schedule_add(name, func, args=''):
+        if name not in leds or func not in leds[name].commands:
+            abort(404)
+        led = leds[name]
+        led.err_msg = None
+        data = None
+        try:
+            data = led._args_from_list(func, args.split('/') if args else [])
+            entry = scheduler.add(led, request.args.get('when'), data)
+        except CommandError as e:
+            return error_response(led, e, data)
+        return Response(json.dumps(entry), mimetype='application/json')
+
+    @app.route(base_url + '/schedule/cancel/<int:entry_id>', methods=['GET'])
+    def schedule_cancel(entry_id):
+        if not scheduler.cancel(entry_id):
+            abort(404)
+        return Response(json.dumps(scheduler.list()), mimetype='application/json')
+
+    if tracer.profiling:
+        @app.route(base_url + '/profile/<int:seconds>', methods=['GET'])
+        @app.route(base_url + '/profile/<float:seconds>', methods=['GET'])
+        def profile(seconds):
+            report = tracer.profile(min(seconds, PROFILE_MAX))
+            if report is None:
+                abort(409, description='a profile is already running')
+            return Response(report, mimetype='text/plain')
+
+    @app.route(base_url + '/status', methods=['GET'])
+    @app.route(base_url + '/<name>/status', methods=['GET'])
+    def status(name=None):
+        if name is not None and name not in status_stream.latest:
+            abort(404)
+        version, body = status_stream.status(name)
+        etag = f"{status_stream.boot}-{version}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @app.route(base_url + '/stream', methods=['GET'])
+    @app.route(base_url + '/<name>/stream', methods=['GET'])
+    def stream(name=None):
+        names = None
+        if name:
+            names = [name]
+        elif request.args.get('leds'):
+            names = request.args['leds'].split(',')
+        if names and not all(n in leds for n in names):
+            abort(404)
+        try:
+            interval = float(request.args.get('interval', STREAM_INTERVAL))
+        except ValueError:
+            abort(400)
+
+        def events():
+            cursor, frames = status_stream.snapshot(names)
+            yield frames
+            while True:
+                time.sleep(interval)
+                cursor, frames = status_stream.wait(cursor, names, STREAM_KEEPALIVE)
+                yield frames or ': keepalive\n\n'
+        return Response(events(), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'})
+
     print(f"REST interface listening on port {config['rest']['port']} with url={base_url}/")
     app.run(host='0.0.0.0', port=config['rest']['port'])
 
+def udp_listen():
+    # Precompute led index -> command id -> schema, in config file order
+    names = [section for section in config.sections() if section in leds] or list(leds)
+    table = []
+    for name in names:
+        led = leds[name]
+        print(f"UDP index {len(table)}: {name}")
+        table.append([(led, led.schemas.get(cmd, CommandSchema(cmd, [])))
+            if cmd in led.commands else None for cmd in UDP_COMMANDS])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    port = int(config['udp'].get('port', UDP_PORT))
+    sock.bind(('0.0.0.0', port))
+    print(f"UDP interface listening on port {port}")
+    last_seq = {}
+    while True:
+        packet, addr = sock.recvfrom(64)
+        if len(packet) != UDP_FORMAT.size:
+            continue
+        index, cmd_id, seq, arg1, arg2 = UDP_FORMAT.unpack(packet)
+
+        # Drop repeated or stale datagrams from the same sender
+        if addr in last_seq and not 0 < (seq - last_seq[addr]) % 0x10000 < 0x8000:
+            continue
+        last_seq[addr] = seq
+
+        try:
+            entry = table[index][cmd_id]
+        except IndexError:
+            entry = None
+        if entry is None:
+            print(f"UDP: unknown led {index} or command {cmd_id} from {addr[0]}, ignoring")
+            continue
+        led, schema = entry
+        with tracer.command(led.name, 'udp'):
+            try:
+                with tracer.span('args', cmd=schema.cmd):
+                    # Every datagram has room for two args, unused ones are NaN
+                    args = [None if math.isnan(arg1) else arg1, None if math.isnan(arg2) else arg2]
+                    while args and args[-1] is None:
+                        args.pop()
+                    data = schema.from_list(args)
+                led.err_msg = None
+                led.run_command(data)
+            except Exception as e:
+                print(f"UDP: {led.name}.{schema.cmd}: {e}")
+
 if __name__ == '__main__':
     leds = {}
-    wiringPiSetupGpio()
-    if HAVE_PCA:
-        try:
-            pca = PCA9685(busio.I2C(SCL, SDA))
-            pca.frequency = 1000
-        except ValueError:
-            HAVE_PCA = False
     config = configparser.ConfigParser()
-    config.read('/etc/led-controller.ini')
+    # Several servers can share a machine by giving each its own config
+    config.read(sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE)
+    if 'output' in config.sections():
+        backend = config['output'].get('backend', 'wiringpi').lower()
+        if backend not in OUTPUT_BACKENDS:
+            raise Exception(f"[output] unknown backend '{backend}'")
+        output = OUTPUT_BACKENDS[backend](config['output'])
+        if config['output'].getboolean('process', False):
+            output = SharedOutput(output)
+    if 'trace' in config.sections():
+        tracer.configure(config['trace'])
+        output = TracedOutput(output)
+    output.setup()
+    if 'record' in config.sections():
+        recorder.open(config['record'].get('file', RECORD_FILE))
     parse_config()
+    restore_states()
+
+    scheduler.configure(config['schedule'] if 'schedule' in config.sections() else {})
+    scheduler.load()
+    Thread(target=scheduler.run).start()
+    if 'cluster' in config.sections():
+        cluster.configure(config['cluster'])
+        cluster.start()
 
     if HAVE_REST:
         rest_thread = Thread(target=rest_listen)
         rest_thread.start()
 
+    if 'udp' in config.sections():
+        udp_thread = Thread(target=udp_listen)
+        udp_thread.start()
+
     try:
         Event().wait()
     except KeyboardInterrupt:
+        if recorder.file:
+            recorder.snapshot()
         os._exit(1)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#vim: ts=4:et:ai:smartindent
+
+# Copyright 2022 Josh Harding
+# licensed under the terms of the MIT license, see LICENSE file
+
+# Benchmarks for led-controller, see README.md
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import time
+from threading import Thread
+from urllib import request
+
+HAVE_MQTT = True
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    HAVE_MQTT = False
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'led-controller.py')
+
+# Must match the server's UDP_FORMAT and UDP_COMMANDS
+UDP_FORMAT = struct.Struct('!BBHff')
+UDP_COMMANDS = ['on', 'off', 'toggle', 'fade', 'set', 'upto', 'downto', 'inc', 'dec',
+    'set_hue', 'set_sat']
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def report(label, values, unit='ms', scale=1000):
+    if not values:
+        print(f"{label:>10}: no results")
+        return
+    print(f"{label:>10}: n={len(values)} min={min(values)*scale:.2f}{unit} "
+        f"p50={percentile(values, 50)*scale:.2f}{unit} p95={percentile(values, 95)*scale:.2f}{unit} "
+        f"max={max(values)*scale:.2f}{unit}")
+
+# latency: time from sending a toggle until the server's status stream shows the change
+class StreamWatcher:
+    def __init__(self, url):
+        self.events = queue.Queue()
+        self.stream = request.urlopen(url)
+        Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.stream:
+            if line.startswith(b'data:'):
+                self.events.put(time.perf_counter())
+
+    def drain(self, settle=0.2):
+        time.sleep(settle)
+        while not self.events.empty():
+            self.events.get()
+
+def bench_latency(args):
+    base = f"http://{args.server}{'/' + args.base if args.base else ''}"
+    watcher = StreamWatcher(f"{base}/{args.led}/stream?interval=0")
+    senders = {}
+    if 'rest' in args.paths:
+        senders['rest'] = lambda: request.urlopen(f"{base}/{args.led}/toggle").read()
+    if 'mqtt' in args.paths:
+        if not HAVE_MQTT:
+            sys.exit("paho-mqtt is needed for the mqtt path")
+        client = mqtt.Client()
+        client.connect(args.broker)
+        client.loop_start()
+        topic = f"cmd/{args.topic}/{args.led}/req"
+        senders['mqtt'] = lambda: client.publish(topic, '{"cmd": "toggle"}', qos=2)
+    if 'udp' in args.paths:
+        if args.index is None:
+            sys.exit("--index is needed for the udp path")
+        host, _, port = args.udp.partition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        seq = [0]
+        def send_udp():
+            seq[0] = (seq[0] + 1) & 0xFFFF
+            sock.sendto(UDP_FORMAT.pack(args.index, UDP_COMMANDS.index('toggle'), seq[0],
+                math.nan, math.nan), (host, int(port or 8124)))
+        senders['udp'] = send_udp
+
+    for path, send in senders.items():
+        watcher.drain()
+        results = []
+        for i in range(args.count):
+            sent = time.perf_counter()
+            send()
+            try:
+                results.append(watcher.events.get(timeout=args.timeout) - sent)
+            except queue.Empty:
+                print(f"{path}: no status change seen for toggle {i}")
+            time.sleep(args.pause)
+        report(path, results)
+
+def load_server(path):
+    spec = importlib.util.spec_from_file_location('led_controller', path)
+    ledc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ledc)
+    return ledc
+
+# writes: cost of one output write (plus flush) for each backend
+def make_fake_sysfs(root, gpios, pwm_channels):
+    # Just the files the sysfs backend opens, already "exported"
+    for channel in pwm_channels:
+        pwm = os.path.join(root, 'sys/class/pwm/pwmchip0', f'pwm{channel}')
+        os.makedirs(pwm, exist_ok=True)
+        for name in ('period', 'duty_cycle', 'enable'):
+            open(os.path.join(pwm, name), 'w').close()
+    open(os.path.join(root, 'sys/class/pwm/pwmchip0/export'), 'w').close()
+    for gpio in gpios:
+        path = os.path.join(root, 'sys/class/gpio', f'gpio{gpio}')
+        os.makedirs(path, exist_ok=True)
+        for name in ('direction', 'value'):
+            open(os.path.join(path, name), 'w').close()
+    open(os.path.join(root, 'sys/class/gpio/export'), 'w').close()
+
+def time_writes(write, flush, count):
+    started = time.perf_counter()
+    for i in range(count):
+        write(i)
+        flush()
+    return (time.perf_counter() - started) / count
+
+def bench_writes(args):
+    if args.root:
+        time_backends(args, args.root)
+    else:
+        with tempfile.TemporaryDirectory(prefix='led-bench-') as root:
+            time_backends(args, root)
+
+def time_backends(args, root):
+    ledc = load_server(args.server_script)
+    backends = {}
+    if args.root:
+        backends['sysfs'] = ledc.SysfsOutput({'root': root, 'gpio': args.gpio})
+    else:
+        make_fake_sysfs(root, [args.gpio_pin], [ledc.PWM_CHANNELS[args.pwm_pin]])
+        backends['sysfs(fake)'] = ledc.SysfsOutput({'root': root, 'gpio': 'sysfs'})
+    if args.wiringpi:
+        backends['wiringpi'] = ledc.DirectOutput()
+    backends['simulated'] = ledc.SimulatedOutput()
+
+    for name, backend in backends.items():
+        backend.setup()
+        backend.setup_pwm(args.pwm_pin)
+        backend.setup_pin(args.gpio_pin)
+        pwm = time_writes(lambda i: backend.pwm_write(args.pwm_pin, i % ledc.PWM_MAX),
+            backend.flush, args.count)
+        gpio = time_writes(lambda i: backend.digital_write(args.gpio_pin, i & 1),
+            backend.flush, args.count)
+        print(f"{name:>12}: pwm {pwm*1e6:.2f}us/write, gpio {gpio*1e6:.2f}us/write")
+
+# skew: how far apart the nodes of a cluster start the same command
+def bench_skew(args):
+    if not HAVE_MQTT:
+        sys.exit("paho-mqtt is needed for the skew benchmark")
+    reports = queue.Queue()
+    client = mqtt.Client()
+    client.on_message = lambda client, userdata, msg: reports.put(json.loads(msg.payload))
+    client.connect(args.broker)
+    client.subscribe(f"{args.topic}/skew")
+    client.loop_start()
+    time.sleep(1)
+
+    skews, late = [], {}
+    for req_id in range(args.count):
+        cmd = {'cmd': 'fade', 'level': 100 if req_id % 2 else 0, 'duration': 1, 'req_id': req_id}
+        client.publish(f"cmd/{args.topic}/{args.led}/req", json.dumps(cmd), qos=1)
+        started = {}
+        deadline = time.monotonic() + args.timeout
+        while len(started) < args.nodes and time.monotonic() < deadline:
+            try:
+                msg = reports.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if msg.get('req_id') == req_id:
+                started[msg['node']] = msg['started']
+                late.setdefault(msg['node'], []).append(msg['late'])
+        if len(started) < args.nodes:
+            print(f"command {req_id}: only heard from {sorted(started)}")
+        if len(started) > 1:
+            skews.append(max(started.values()) - min(started.values()))
+        time.sleep(args.pause)
+
+    report('skew', skews)
+    for node, values in sorted(late.items()):
+        report(node, values)
+
+# pixels: whole-strip fade frames per second, with SPI writes captured
+class FakeSpi:
+    def __init__(self):
+        self.frames = 0
+        self.last = None
+
+    def writebytes2(self, buf):
+        self.frames += 1
+        self.last = buf
+
+def bench_pixels(args):
+    ledc = load_server(args.server_script)
+    if not ledc.HAVE_PIXELS:
+        sys.exit("numpy is needed for pixel strips")
+    ledc.config = ledc.configparser.ConfigParser()
+    for chip in args.chips:
+        spi = FakeSpi()
+        strip = ledc.LEDPixels('bench', args.count, chip, 'black', spi=spi)
+        strip._stop_timer()
+        strip.fade_to[:] = 1
+        strip.fade_duration = 1
+        started = time.perf_counter()
+        for i in range(args.frames):
+            strip._blend(i / args.frames)
+            strip._render()
+        elapsed = time.perf_counter() - started
+        print(f"{chip:>8}: {args.count} pixels, {args.frames / elapsed:.0f} frames/s "
+            f"({elapsed / args.frames * 1e6:.1f}us/frame, {len(spi.last)} bytes)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for led-controller')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('latency', help='command latency over REST, MQTT and UDP')
+    p.add_argument('--server', default='127.0.0.1:8123', help='REST server host:port')
+    p.add_argument('--base', default='', help='REST base url, if configured')
+    p.add_argument('--led', default='led', help='name of the light to toggle')
+    p.add_argument('--paths', default='rest,mqtt,udp', type=lambda s: s.split(','))
+    p.add_argument('--broker', default='mqtt-broker')
+    p.add_argument('--topic', default='led', help='server\'s [mqtt] topic')
+    p.add_argument('--udp', default='127.0.0.1:8124', help='UDP server host:port')
+    p.add_argument('--index', type=int, help='UDP index of the light')
+    p.add_argument('--count', type=int, default=50)
+    p.add_argument('--pause', type=float, default=0.1, help='seconds between commands')
+    p.add_argument('--timeout', type=float, default=2)
+    p.set_defaults(func=bench_latency)
+
+    p = sub.add_parser('writes', help='cost of a single output write for each backend')
+    p.add_argument('--root', help='use the real sysfs here (e.g. /) instead of a fake tree')
+    p.add_argument('--gpio', default='chardev', help='GPIO mode for --root: chardev or sysfs')
+    p.add_argument('--wiringpi', action='store_true', help='also time wiringpi (needs a Pi and root)')
+    p.add_argument('--pwm-pin', type=int, default=18)
+    p.add_argument('--gpio-pin', type=int, default=23)
+    p.add_argument('--count', type=int, default=10000)
+    p.add_argument('--server-script', default=SERVER_SCRIPT)
+    p.set_defaults(func=bench_writes)
+
+    p = sub.add_parser('skew', help='start time differences between cluster nodes')
+    p.add_argument('--broker', default='mqtt-broker')
+    p.add_argument('--topic', default='cluster', help='servers\' [cluster] topic')
+    p.add_argument('--led', default='led', help='light that every node has')
+    p.add_argument('--nodes', type=int, default=2, help='how many nodes to wait for')
+    p.add_argument('--count', type=int, default=20)
+    p.add_argument('--pause', type=float, default=1.5, help='seconds between commands')
+    p.add_argument('--timeout', type=float, default=2)
+    p.set_defaults(func=bench_skew)
+
+    p = sub.add_parser('pixels', help='frame rate of a pixel strip fade')
+    p.add_argument('--count', type=int, default=300, help='pixels in the strip')
+    p.add_argument('--frames', type=int, default=2000)
+    p.add_argument('--chips', default='ws2812,apa102', type=lambda s: s.split(','))
+    p.add_argument('--server-script', default=SERVER_SCRIPT)
+    p.set_defaults(func=bench_pixels)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#vim: ts=4:et:ai:smartindent
+
+# Copyright 2022 Josh Harding
+# licensed under the terms of the MIT license, see LICENSE file
+
+# Replays a command log recorded by led-controller ([record] section),
+# see README.md
+
+import argparse
+import configparser
+import importlib.util
+import json
+import os
+import sys
+import time
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+HAVE_MQTT = True
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    HAVE_MQTT = False
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'led-controller.py')
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def report(label, values):
+    if not values:
+        print(f"{label:>10}: no results")
+        return
+    print(f"{label:>10}: n={len(values)} p50={percentile(values, 50)*1000:.2f}ms "
+        f"p90={percentile(values, 90)*1000:.2f}ms p99={percentile(values, 99)*1000:.2f}ms "
+        f"max={max(values)*1000:.2f}ms")
+
+def same_status(a, b):
+    if a.keys() != b.keys():
+        return False
+    for key in a:
+        if isinstance(a[key], (int, float)) and isinstance(b[key], (int, float)):
+            if abs(a[key] - b[key]) > 0.5:
+                return False
+        elif a[key] != b[key]:
+            return False
+    return True
+
+def read_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def paced(entries, speed):
+    # Yields entries at their recorded times, scaled by speed (0 = as fast as possible)
+    first = entries[0][0]
+    start = time.monotonic()
+    for entry in entries:
+        due = start + (entry[0] - first) / speed if speed else time.monotonic()
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield time.monotonic() - due, entry
+
+def report_divergence(entries, snapshots, final):
+    # Every light as of the last snapshot, then anything commanded after it
+    expected = dict(snapshots[-1][4]) if snapshots else {}
+    after = snapshots[-1][0] if snapshots else 0
+    for received, source, name, data, status in entries:
+        if received >= after:
+            expected[name] = status
+    diverged = 0
+    for name, status in expected.items():
+        if name not in final:
+            print(f"  {name}: no final status")
+            diverged += 1
+        elif not same_status(status, final[name]):
+            print(f"  {name}: expected {status}, got {final[name]}")
+            diverged += 1
+    print(f"final state: {len(expected) - diverged} of {len(expected)} lights match the recording")
+
+# Runs the server's LED classes in this process with simulated output
+def replay_direct(args, entries):
+    spec = importlib.util.spec_from_file_location('led_controller', args.server_script)
+    ledc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ledc)
+    config = configparser.ConfigParser()
+    config.read(args.direct)
+    for section in ledc.SERVICE_SECTIONS:
+        config.remove_section(section)
+    ledc.config = config
+    ledc.leds = {}
+    ledc.output = ledc.SimulatedOutput()
+    ledc.parse_config()
+    # Schedules and cluster commands in the log run from here
+    Thread(target=ledc.scheduler.run, daemon=True).start()
+
+    latency, lateness, dropped, rejected = [], [], 0, 0
+    for late, (received, source, name, data, status) in paced(entries, args.speed):
+        lateness.append(late)
+        led = ledc.leds.get(name)
+        if led is None:
+            dropped += 1
+            continue
+        started = time.perf_counter()
+        if source == 'mqtt':
+            # Goes through the same checks as it did in the server, rejects included
+            payload = data if isinstance(data, str) else json.dumps(data)
+            led._mqtt_message(None, None, SimpleNamespace(topic=name, payload=payload.encode()))
+            if led.err_msg:
+                rejected += 1
+        else:
+            try:
+                led.run_command(led._args_from_dict(dict(data)))
+            except Exception as e:
+                print(f"{name} {data}: {e}")
+                dropped += 1
+                continue
+        latency.append(time.perf_counter() - started)
+
+    print(f"replayed {len(entries)} commands, {dropped} dropped, {rejected} rejected, "
+        f"{ledc.output.writes} output writes")
+    report('latency', latency)
+    report('late', lateness)
+    report_divergence(entries, args.snapshots, {name: led._get_status() for name, led in ledc.leds.items()})
+
+# Sends the commands to a running server through a broker and matches up
+# the status responses with req_id
+def replay_broker(args, entries):
+    if not HAVE_MQTT:
+        sys.exit("paho-mqtt is needed to replay through a broker")
+    lock = Lock()
+    sent = {}
+    latency = []
+    last_seen = {}
+    final = {}
+    reordered = 0
+
+    def on_message(client, userdata, msg):
+        nonlocal reordered
+        received = time.perf_counter()
+        try:
+            status = json.loads(msg.payload)
+        except ValueError:
+            return
+        req_id = status.pop('req_id', None)
+        status.pop('isStateChange', None)
+        status.pop('error', None)
+        name = msg.topic.split('/')[-2]
+        with lock:
+            # Lights changed by a group have no req_id, but count for the final state
+            final[name] = status
+            if req_id not in sent:
+                return
+            latency.append(received - sent.pop(req_id))
+            if req_id < last_seen.get(name, -1):
+                reordered += 1
+            last_seen[name] = max(req_id, last_seen.get(name, -1))
+
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(args.broker)
+    client.subscribe(f"cmd/{args.topic}/+/resp")
+    client.loop_start()
+    time.sleep(1)
+
+    lateness = []
+    for req_id, (late, (received, source, name, data, status)) in enumerate(paced(entries, args.speed)):
+        lateness.append(late)
+        if isinstance(data, str):
+            # Not JSON when it was received, so send it as it was without a req_id
+            client.publish(f"cmd/{args.topic}/{name}/req", data, qos=args.qos)
+            continue
+        with lock:
+            sent[req_id] = time.perf_counter()
+        client.publish(f"cmd/{args.topic}/{name}/req", json.dumps(dict(data, req_id=req_id)), qos=args.qos)
+
+    deadline = time.monotonic() + args.timeout
+    while sent and time.monotonic() < deadline:
+        time.sleep(0.1)
+    client.loop_stop()
+
+    print(f"replayed {len(entries)} commands, {len(sent)} dropped, {reordered} reordered")
+    report('latency', latency)
+    report('late', lateness)
+    report_divergence(entries, args.snapshots, final)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a led-controller command log')
+    parser.add_argument('log', help='file written by the [record] section')
+    parser.add_argument('--speed', default='1',
+        help='1 = as recorded, N = N times faster, max = no waiting')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--direct', metavar='CONFIG',
+        help='run the commands in this process, with lights from this config file')
+    target.add_argument('--broker', help='send the commands to a server through this MQTT broker')
+    parser.add_argument('--topic', default='led', help='server\'s [mqtt] topic')
+    parser.add_argument('--qos', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=5,
+        help='seconds to wait for outstanding responses')
+    parser.add_argument('--server-script', default=SERVER_SCRIPT)
+    args = parser.parse_args()
+    args.speed = 0 if args.speed == 'max' else float(args.speed)
+
+    entries = read_log(args.log)
+    args.snapshots = [entry for entry in entries if entry[1] == 'snapshot']
+    entries = [entry for entry in entries if entry[1] != 'snapshot']
+    if not entries:
+        sys.exit(f"{args.log} has no commands")
+    if args.direct:
+        replay_direct(args, entries)
+    else:
+        replay_broker(args, entries)
+    # Don't wait for fades and other timers still running
+    sys.stdout.flush()
+    os._exit(0)